@@ -1,15 +1,19 @@
 # coding: utf8
 import random
+import threading
 import time
 import logging
+import weakref
+from bisect import bisect_right
 
-from db import send_message, update_player
+from db import make_keyboard_markup, send_message
 
 from constants import *
 
 SUPERMIND = (("SUPERMIND",), u"🌐")
 LAB = (("LAB",), u"🗺")
 AVATAR = (("AVATAR",), u"🤡")
+START_KEYBOARD = [[(("CONTINUE",), u"Продолжить")]]
 
 
 def get_map_keyboard_item(dir_id, adj):
@@ -20,19 +24,24 @@ def get_map_keyboard(dir_ids, adj):
     return [get_map_keyboard_item(dir_id, adj) for dir_id in dir_ids]
 
 
-def do_show_map(player, bot, gamedata, pdb):
-    loc = gamedata._map[player._location_id]
-    text = player._location_id + u" " + loc._descr
-    text = text + u"\nИсследовано {}%".format(player._research_percent[player._location_id])
-    adj = loc._adjacent
-
-    keyboard = [
+def get_show_map_keyboard(player, gamedata):
+    adj = gamedata._map[player._location_id]._adjacent
+    return [
         [SUPERMIND] + get_map_keyboard(["NW", "N", "NE"], adj),
         [LAB, get_map_keyboard_item("W", adj), (("SHOWVENUES",), u"🔄"), get_map_keyboard_item("E", adj)],
         [AVATAR] + get_map_keyboard(["SW", "S", "SE"], adj)
     ]
-    with pdb.connect() as conn:
-        send_message(player, conn, bot, text, keyboard)
+
+
+def get_location_header(gamedata, loc_id):
+    return get_compiled(gamedata, ("HEADER", loc_id),
+                        lambda: loc_id + u" " + gamedata._map[loc_id]._descr)
+
+
+def do_show_map(player, bot, gamedata, pdb):
+    text = get_location_header(gamedata, player._location_id)
+    text = text + u"\nИсследовано {}%".format(player._research_percent[player._location_id])
+    send_screen(player, bot, gamedata, pdb, text, ("MAP",))
 
 
 def get_show_venues_keyboard(player, gamedata):
@@ -54,37 +63,178 @@ def get_show_venues_keyboard(player, gamedata):
     return keyboard
 
 
-def do_show_venue(player, bot, gamedata, pdb, venue_id):
+def get_show_venue_keyboard(player, gamedata, venue_id):
     loc = gamedata._map[player._location_id]
     keyboard = [
         [SUPERMIND, LAB, AVATAR, (("SHOWMAP",), u"🔄")]
     ]
-    text = ""
-    for vid, venue_descr, _ in loc._venues:
+    for vid, _, _ in loc._venues:
         if vid == venue_id:
-            text = venue_descr
             for option in gamedata._venues[venue_id]._options:
                 keyboard.append([(("VENUEACTION", option[0], option[1]), option[0])])
     keyboard.append([(("SHOWVENUES",), u"Назад")])
-    with pdb.connect() as conn:
-        send_message(player, conn, bot, text, keyboard)
+    return keyboard
+
+
+def get_venue_descr(gamedata, loc_id, venue_id):
+    text = ""
+    for vid, venue_descr, _ in gamedata._map[loc_id]._venues:
+        if vid == venue_id:
+            text = venue_descr
+    return text
+
+
+def do_show_venue(player, bot, gamedata, pdb, venue_id):
+    loc_id = player._location_id
+    text = get_compiled(gamedata, ("VENUE_DESCR", loc_id, venue_id),
+                        lambda: get_venue_descr(gamedata, loc_id, venue_id))
+    send_screen(player, bot, gamedata, pdb, text, ("VENUE", venue_id))
 
 
 def do_show_venues(player, bot, gamedata, pdb):
-    loc = gamedata._map[player._location_id]
-    text = player._location_id + u" " + loc._descr
+    text = get_location_header(gamedata, player._location_id)
     text = text + u"\nИсследовано {}%".format(player._research_percent[player._location_id])
-    keyboard = get_show_venues_keyboard(player, gamedata)
-    with pdb.connect() as conn:
-        send_message(player, conn, bot, text, keyboard)
+    send_screen(player, bot, gamedata, pdb, text, ("VENUES",))
+
+
+def get_outcomes_keyboard(player, gamedata, event_id, text_id, lore_gained):
+    _, options = gamedata._texts[event_id][text_id]
+    keyboard = list()
+    for option_text in options:
+        action = ("GETOUTCOME", event_id, text_id, option_text, False, lore_gained)
+        keyboard.append([(action, option_text)])
+    return keyboard
+
+
+def get_start_keyboard(player, gamedata):
+    return START_KEYBOARD
 
 
-def choose_outcome(outcomes):
-    p = random.random()
-    for accu_prob, outcome in outcomes:
-        if p < accu_prob:
-            return outcome
-    assert False, "bad probabilities"
+def get_empty_keyboard(player, gamedata):
+    return []
+
+
+# keyboard id head -> builder. Only the id is stored in the database, the
+# keyboard is rebuilt from it and the player's state when needed.
+KEYBOARDS = {
+    "START": get_start_keyboard,
+    "EMPTY": get_empty_keyboard,
+    "MAP": get_show_map_keyboard,
+    "VENUES": get_show_venues_keyboard,
+    "VENUE": get_show_venue_keyboard,
+    "OUTCOMES": get_outcomes_keyboard
+}
+
+
+# GameData -> dict of keyboards, markups and texts built from it. Loaded
+# game data is never modified, so entries live as long as their GameData.
+_compiled = weakref.WeakKeyDictionary()
+_compiled_lock = threading.Lock()
+
+
+def get_compiled(gamedata, key, build):
+    with _compiled_lock:
+        compiled = _compiled.get(gamedata)
+        if compiled is None:
+            compiled = _compiled[gamedata] = dict()
+    value = compiled.get(key)
+    if value is None:
+        value = compiled[key] = build()
+    return value
+
+
+def get_research_bucket(player, gamedata):
+    """
+    The number of the location's venue thresholds the player's research
+    has reached: players in one bucket see the same venues.
+    """
+    loc_id = player._location_id
+    thresholds = get_compiled(gamedata, ("THRESHOLDS", loc_id), lambda: sorted(
+        threshold for _, _, threshold in gamedata._map[loc_id]._venues))
+    return bisect_right(thresholds, player._research_percent.get(loc_id, 0))
+
+
+# keyboard id head -> what besides the keyboard id and game data the
+# keyboard depends on, keyboards missing here are built on every call
+SCREEN_KEYS = {
+    "START": lambda player, gamedata: (),
+    "EMPTY": lambda player, gamedata: (),
+    "MAP": lambda player, gamedata: (player._location_id,),
+    "VENUES": lambda player, gamedata: (player._location_id,
+                                        get_research_bucket(player, gamedata)),
+    "VENUE": lambda player, gamedata: (player._location_id,)
+}
+
+
+def build_screen(keyboard_id, player, gamedata):
+    """
+    Returns (keyboard, reply markup, button text -> action dict).
+    """
+    keyboard = KEYBOARDS[keyboard_id[0]](player, gamedata, *keyboard_id[1:])
+    return keyboard, make_keyboard_markup(keyboard), get_keyboard_actions(keyboard)
+
+
+def get_screen(keyboard_id, player, gamedata):
+    try:
+        get_key = SCREEN_KEYS.get(keyboard_id[0])
+        if get_key is None:
+            return build_screen(keyboard_id, player, gamedata)
+        return get_compiled(gamedata, (keyboard_id,) + get_key(player, gamedata),
+                            lambda: build_screen(keyboard_id, player, gamedata))
+    except KeyError as e:
+        # the screen refers to game data removed by /reload
+        logging.warning(u"can't build keyboard {}: {}".format(keyboard_id, e).encode("utf8"))
+        return [], make_keyboard_markup([]), dict()
+
+
+def get_keyboard(keyboard_id, player, gamedata):
+    return get_screen(keyboard_id, player, gamedata)[0]
+
+
+def get_keyboard_actions(keyboard, suggested_actions=None):
+    if suggested_actions is None:
+        suggested_actions = dict()
+    for row in keyboard:
+        for action, button_text in row:
+            suggested_actions[button_text] = action
+    return suggested_actions
+
+
+def guess_suggested_actions(player, gamedata):
+    """
+    Button text -> action for a player without a stored keyboard id, as
+    written for map and venue screens before every id was stored: the
+    buttons of the screens the player can see at its location. A text that
+    means different actions on different screens is left out rather than
+    guessed.
+    """
+    loc_id = player._location_id
+    researched = player._research_percent.get(loc_id, 0)
+    keyboard_ids = [("MAP",), ("VENUES",)]
+    loc = gamedata._map.get(loc_id)
+    if loc is not None:
+        for venue_id, _, research_threshold in loc._venues:
+            if venue_id in gamedata._venues and researched >= research_threshold:
+                keyboard_ids.append(("VENUE", venue_id))
+    keyboard_ids.append(("START",))
+    suggested_actions = dict()
+    conflicts = set()
+    for keyboard_id in keyboard_ids:
+        for button_text, action in get_screen(keyboard_id, player, gamedata)[2].iteritems():
+            if suggested_actions.setdefault(button_text, action) != action:
+                conflicts.add(button_text)
+    for button_text in conflicts:
+        del suggested_actions[button_text]
+    return suggested_actions
+
+
+def send_screen(player, bot, gamedata, pdb, text, keyboard_id):
+    keyboard, markup, suggested_actions = get_screen(keyboard_id, player, gamedata)
+    send_message(player, pdb, bot, text, keyboard, keyboard_id, markup, suggested_actions)
+
+
+def choose_outcome(outcomes, rng=random):
+    return outcomes.choose(rng)
 
 
 def do_get_outcome(player, bot, gamedata, pdb, event_id, text_id, option_text,
@@ -111,7 +261,7 @@ def do_get_outcome(player, bot, gamedata, pdb, event_id, text_id, option_text,
                 free_weight= backpack._max_weight - backpack.get_weight(gamedata)
                 taken_count = int(min(free_weight / item._weight, outcome._cnt))
                 if taken_count > 0:
-                    backpack.insert_item(outcome_id, taken_count)
+                    player.insert_item(outcome_id, taken_count, gamedata)
                     message += u"\n{} ({}) помещён(-а) в рюкзак".format(
                         item._name, taken_count
                     )
@@ -126,19 +276,14 @@ def do_get_outcome(player, bot, gamedata, pdb, event_id, text_id, option_text,
             message += outcome_id
     if lore_gained > 0:
         message += u"\nПолучено {} ЗМ за исследование".format(lore_gained)
-    keyboard = get_show_venues_keyboard(player, gamedata)
-    with pdb.connect() as conn:
-        update_player(player, conn)
-        send_message(player, conn, bot, message, keyboard)
+    send_screen(player, bot, gamedata, pdb, message, ("VENUES",))
 
 
 def resolve_event(player, bot, gamedata, pdb, event_id, lore_gained):
     if event_id not in gamedata._texts:
         logging.warning(u"no data for event: {}".format(event_id).encode("utf8"))
-        with pdb.connect() as conn:
-            send_message(player, conn, bot,
-                         u"no data for event: {}".format(event_id),
-                         get_show_venues_keyboard(player, gamedata))
+        send_screen(player, bot, gamedata, pdb,
+                    u"no data for event: {}".format(event_id), ("VENUES",))
         return
 
     text_id = random.choice(gamedata._texts[event_id].keys())
@@ -148,14 +293,8 @@ def resolve_event(player, bot, gamedata, pdb, event_id, lore_gained):
                        options.keys()[0], True, lore_gained)
         return
 
-    message = descr
-    keyboard = list()
-    for option_text, outcomes in options.iteritems():
-        action = ("GETOUTCOME", event_id, text_id, option_text, False, lore_gained)
-        keyboard.append([(action, option_text)])
-
-    with pdb.connect() as conn:
-        send_message(player, conn, bot, message, keyboard)
+    send_screen(player, bot, gamedata, pdb, descr,
+                ("OUTCOMES", event_id, text_id, lore_gained))
 
 
 def do_explore(player, bot, gamedata, pdb):
@@ -169,20 +308,18 @@ def do_explore(player, bot, gamedata, pdb):
     researched = min(loc._research_rate, 100 - player._research_percent[player._location_id])
     lore_gained = int(researched * 0.1 * player.get_cpu())
     if researched > 0:
-        with pdb.connect() as conn:
-            player.update_lore(gamedata)
-            player._raw_lore += lore_gained
-            player._lore_last_update = time.time()
-            player._research_percent[player._location_id] += researched
-            update_player(player, conn)
+        player.update_lore(gamedata)
+        player._raw_lore += lore_gained
+        player._lore_last_update = time.time()
+        player.add_research(player._location_id, researched)
+        pdb.update(player)
 
     event_id = choose_outcome(gamedata._venues[venue_id]._events)
     resolve_event(player, bot, gamedata, pdb, event_id, lore_gained)
 
 
 def do_venue_action(player, bot, gamedata, pdb, venue_option, venue_message):
-    with pdb.connect() as conn:
-        send_message(player, conn, bot, venue_message, [])
+    send_screen(player, bot, gamedata, pdb, venue_message, ("EMPTY",))
 
     loc = gamedata._map[player._location_id]
     outcomes = loc._venue_option2events[venue_option]
@@ -217,17 +354,17 @@ def do_nothing(player, bot, gamedata, pdb):
 
 def do_change_location(player, bot, gamedata, pdb, to_loc_id):
     cur_loc_id = player._location_id
-    with pdb.connect() as conn:
-        player.set_location(to_loc_id)
-        try:
-            update_player(player, conn)
-        except Exception as e:
-            player.set_location(cur_loc_id)
-            raise e
+    player.set_location(to_loc_id)
+    try:
+        pdb.update(player)
+    except Exception as e:
+        player.set_location(cur_loc_id)
+        raise e
     do_show_map(player, bot, gamedata, pdb)
 
 
 def do_cancel(player, bot, gamedata, pdb, prev_action):
+    player.cancel_delayed_action(bot)
     player.do_action(prev_action, bot, gamedata, pdb)
 
 
@@ -285,41 +422,39 @@ def format_time(seconds):
 
 
 def do_show_mind(player, bot, gamedata, pdb):
-    with pdb.connect() as conn:
-        player.update_lore(gamedata)
-        update_player(player, conn)
-        text = u"{}\nЗнание Мира: {}\nСырое ЗМ: {}".format(
-            player.get_name(), player._lore, player._raw_lore
+    player.update_lore(gamedata)
+    pdb.update(player)
+    text = u"{}\nЗнание Мира: {}\nСырое ЗМ: {}".format(
+        player.get_name(), player._lore, player._raw_lore
+    )
+    if player._raw_lore > 0:
+        text += u", время обработки: {}\n".format(
+            format_time(player._raw_lore * 1. / player.get_cpu() * 60)
         )
-        if player._raw_lore > 0:
-            text += u", время обработки: {}\n".format(
-                format_time(player._raw_lore * 1. / player.get_cpu() * 60)
+    else:
+        text += u"\n"
+    text += u"""Использование памяти: {} / {}\nЗагрузка CPU: {} / {}\n""".format(
+            player.get_used_ram(gamedata), player.get_ram(),
+            player.get_used_cpu(gamedata), player.get_cpu()
             )
-        else:
-            text += u"\n"
-        text += u"""Использование памяти: {} / {}\nЗагрузка CPU: {} / {}\n""".format(
-                player.get_used_ram(gamedata), player.get_ram(),
-                player.get_used_cpu(gamedata), player.get_cpu()
-                )
-        text += u"Запущенных программ: {}\n".format(len(player._running_soft))
-        text += u"Скомпилированных программ: {}\n".format(len(player._installed_soft))
-        text += u"Новых программ: {} /software".format(
-            len(gamedata._programs)
-        )
-        if player._compiling_soft != []:
-            program = gamedata._programs[player._compiling_soft[0]]
-            cpu, start_time = player._compiling_soft[1:3]
-            ts = time.time()
-            progress = (ts - start_time) / (program._compile_time / cpu * TICK_DURATION)
-            progress = int(progress * 100)
-            text += u"\nКомпиляция {} выполнена на {}%".format(program._name, progress)
-        send_message(player, conn, bot, text)
+    text += u"Запущенных программ: {}\n".format(len(player._running_soft))
+    text += u"Скомпилированных программ: {}\n".format(len(player._installed_soft))
+    text += u"Новых программ: {} /software".format(
+        len(gamedata._programs)
+    )
+    if player._compiling_soft != []:
+        program = gamedata._programs[player._compiling_soft[0]]
+        cpu, start_time = player._compiling_soft[1:3]
+        ts = time.time()
+        progress = (ts - start_time) / (program._compile_time / cpu * TICK_DURATION)
+        progress = int(progress * 100)
+        text += u"\nКомпиляция {} выполнена на {}%".format(program._name, progress)
+    send_message(player, pdb, bot, text)
 
 
 def do_show_software(player, bot, gamedata, pdb):
-    with pdb.connect() as conn:
-        player.update_lore(gamedata)
-        update_player(player, conn)
+    player.update_lore(gamedata)
+    pdb.update(player)
     text = u""
     if player._running_soft:
         text += u"Запущенные программы:\n"
@@ -339,62 +474,57 @@ def do_show_software(player, bot, gamedata, pdb):
 
 
 def do_compile_program(player, bot, gamedata, pdb, program_id):
-    with pdb.connect() as conn:
-        player.update_lore(gamedata)
-        update_player(player, conn)
-        if player._compiling_soft != []:
-            bot.send_message(player._chat_id, u"Другая программа ещё компилируется")
+    player.update_lore(gamedata)
+    pdb.update(player)
+    if player._compiling_soft != []:
+        bot.send_message(player._chat_id, u"Другая программа ещё компилируется")
+    else:
+        if player.compile_program(program_id, gamedata):
+            pdb.update(player)
+            send_message(player, pdb, bot,
+                        u"Компилирую {}".format(gamedata._programs[program_id]._name))
         else:
-            if player.compile_program(program_id, gamedata):
-                update_player(player, conn)
-                send_message(player, conn, bot,
-                            u"Компилирую {}".format(gamedata._programs[program_id]._name))
-            else:
-                bot.send_message(player._chat_id,
-                                 u"Недостаточно ЦП для начала компиляции")
+            bot.send_message(player._chat_id,
+                             u"Недостаточно ЦП для начала компиляции")
 
 
 def do_run_program(player, bot, gamedata, pdb, program_id):
-    with pdb.connect() as conn:
-        player.update_lore(gamedata)
-        update_player(player, conn)
-        if program_id not in player._installed_soft:
-            bot.send_message(player._chat_id, u"Нужно сперва скомпилировать программу")
-            return
-        program = gamedata._programs[program_id]
-        cpu_ok = (player.get_cpu() - player.get_used_cpu(gamedata)) >= program._cpu_usage
-        ram_ok = (player.get_ram() - player.get_used_ram(gamedata)) >= program._ram_usage
-        if cpu_ok and ram_ok:
-            player._running_soft.add(program_id)
-            player._installed_soft.remove(program_id)
-            update_player(player, conn)
-            bot.send_message(player._chat_id,
-                             u"Запускаю {}".format(gamedata._programs[program_id]._name))
-        else:
-            text = u"Не удалось запустить программу\n"
-            if not cpu_ok:
-                text += u"Недостаточно CPU\n"
-            if not ram_ok:
-                text += u"Недостаточно свободной памяти\n"
-            bot.send_message(player._chat_id, text)
+    player.update_lore(gamedata)
+    pdb.update(player)
+    if program_id not in player._installed_soft:
+        bot.send_message(player._chat_id, u"Нужно сперва скомпилировать программу")
+        return
+    program = gamedata._programs[program_id]
+    cpu_ok = (player.get_cpu() - player.get_used_cpu(gamedata)) >= program._cpu_usage
+    ram_ok = (player.get_ram() - player.get_used_ram(gamedata)) >= program._ram_usage
+    if cpu_ok and ram_ok:
+        player.start_program(program_id, gamedata)
+        pdb.update(player)
+        bot.send_message(player._chat_id,
+                         u"Запускаю {}".format(gamedata._programs[program_id]._name))
+    else:
+        text = u"Не удалось запустить программу\n"
+        if not cpu_ok:
+            text += u"Недостаточно CPU\n"
+        if not ram_ok:
+            text += u"Недостаточно свободной памяти\n"
+        bot.send_message(player._chat_id, text)
 
 
 def do_stop_program(player, bot, gamedata, pdb, program_id):
-    with pdb.connect() as conn:
-        player.update_lore(gamedata)
-        update_player(player, conn)
-        program = gamedata._programs.get(program_id)
-        if program is None:
-            return
-        if program_id not in player._running_soft:
-            bot.send_message(player._chat_id,
-                             u"Программа {} не запущена".format(program._name))
-            return
-        player._running_soft.remove(program_id)
-        player._installed_soft.add(program_id)
-        update_player(player, conn)
+    player.update_lore(gamedata)
+    pdb.update(player)
+    program = gamedata._programs.get(program_id)
+    if program is None:
+        return
+    if program_id not in player._running_soft:
         bot.send_message(player._chat_id,
-                         u"Программа {} остановлена".format(program._name))
+                         u"Программа {} не запущена".format(program._name))
+        return
+    player.stop_program(program_id, gamedata)
+    pdb.update(player)
+    bot.send_message(player._chat_id,
+                     u"Программа {} остановлена".format(program._name))
 
 
 def do_view_info(player, bot, gamedata, pdb, entity_id):
@@ -410,7 +540,7 @@ def do_view_info(player, bot, gamedata, pdb, entity_id):
 def do_view_avatar(player, bot, gamedata, pdb):
     backpack = player._avatar._backpack
     message = u"Предметы в рюкзаке:\n"
-    for item, count in backpack._items:
+    for item, count in backpack.get_items():
         message += u"{} ({}) /view_{}\n".format(gamedata._items[item]._name, count, item)
     weight = backpack.get_weight(gamedata)
     message += u"Вес: {} / {}".format(weight, backpack._max_weight)
@@ -7,7 +7,9 @@ except:
 
 import psycopg2
 
-from db import FIELDS
+from db import FIELDS, notify_players_changed, set_blob_format
+from id_sets import IdSet, encode_id_set
+from player import Avatar, encode_avatar
 
 cfg = configparser.RawConfigParser()
 cfg.read("config.ini")
@@ -17,6 +19,9 @@ kwargs = {
     "user": cfg.get("player_db", "user"),
     "password": cfg.get("player_db", "password")
 }
+# the values must be encoded for the columns' current format
+if cfg.has_option("player_db", "blob_format"):
+    set_blob_format(cfg.get("player_db", "blob_format"))
 with psycopg2.connect(**kwargs) as conn:
     with conn.cursor() as curs:
         curs.execute("SELECT * FROM Players")
@@ -26,10 +31,12 @@ with psycopg2.connect(**kwargs) as conn:
         # command = "ALTER TABLE Players ADD AVATAR VARCHAR(50000), ADD KNOWN_ENTITES VARCHAR(50000)"
         # print(command)
         # curs.execute(command)
-        command = "UPDATE Players SET AVATAR = '{\"backpack\":{\"items\":[]}}', KNOWN_ENTITES = '{}'"
+        command = "UPDATE Players SET AVATAR = %s, KNOWN_ENTITES = %s"
         print(command)
-        curs.execute(command)
+        curs.execute(command, (encode_avatar(Avatar()), encode_id_set(IdSet())))
+    notify_players_changed(conn, columns=["AVATAR", "KNOWN_ENTITES"])
 
+    with conn.cursor() as curs:
         curs.execute("SELECT * FROM Players")
         for row in curs.fetchall():
             print(*row)
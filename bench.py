@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding: utf8
+"""
+Micro-benchmarks of the bot's hot paths, see `python bench.py -h`.
+"""
+from __future__ import print_function
+import argparse
+import random
+import sys
+import timeit
+import ConfigParser as configparser
+
+from db import BLOB_FORMATS, set_blob_format
+from map import (DIR2DIR_ID, GameData, Item, Location, Position, Program, Transition,
+                 Venue, accumulate_probs, load_gamedata)
+from id_sets import IdSet
+from player import LAZY_COLUMNS, Player
+
+
+def make_player(locations, items):
+    player = Player(1, 1)
+    for index in range(locations):
+        player.set_location("{:03d}".format(index))
+        player.add_research(player._location_id, index % 100)
+    for index in range(items):
+        item_id = u"i_{}".format(index)
+        player.insert_item(item_id, index % 5 + 1)
+        player._known_entities.add(item_id)
+    player.set_keyboard(("OUTCOMES", u"событие", u"текст", 10), [])
+    player._known_soft = IdSet(u"p_{}".format(index) for index in range(items / 10))
+    player._lore_last_update = 0
+    return player
+
+
+def stored_row(row):
+    # what psycopg2 returns for the values to_row() produced
+    return [buffer(value.adapted) if hasattr(value, "adapted") else value for value in row]
+
+
+def decode_all(row):
+    # from_row leaves the blob columns to first access
+    player = Player.from_row(row)
+    for attr, _, _ in LAZY_COLUMNS:
+        getattr(player, attr)
+    return player
+
+
+def bench_codec(args):
+    player = make_player(args.locations, args.items)
+    print("format\trow bytes\tto_row us\tfrom_row us\tdecode all us")
+    for blob_format in BLOB_FORMATS:
+        set_blob_format(blob_format)
+        row = stored_row(player.to_row())
+        size = sum(len(value) for value in row if isinstance(value, (basestring, buffer)))
+        decoded = decode_all(row)
+        encode = timeit.timeit(decoded.to_row, number=args.number) / args.number
+        lazy = timeit.timeit(lambda: Player.from_row(row), number=args.number) / args.number
+        decode = timeit.timeit(lambda: decode_all(row), number=args.number) / args.number
+        print("{}\t{}\t{:.1f}\t{:.1f}\t{:.1f}".format(blob_format, size, encode * 1e6,
+                                                   lazy * 1e6, decode * 1e6))
+
+
+def scan_outcome(outcomes, rng):
+    # the linear scan Sampler.choose replaced
+    p = rng.random()
+    for accu_prob, outcome in outcomes:
+        if p < accu_prob:
+            return outcome
+    assert False, "bad probabilities"
+
+
+def make_tables(sizes):
+    rng = random.Random(0)
+    tables = list()
+    for size in sizes:
+        weights = [rng.random() for _ in range(size)]
+        total = sum(weights)
+        tables.append(("random {}".format(size),
+                       accumulate_probs([(weight / total, index)
+                                         for index, weight in enumerate(weights)])))
+    return tables
+
+
+def load_tables(cfg_filename, count):
+    cfg = configparser.RawConfigParser()
+    cfg.read(cfg_filename)
+    gamedata = load_gamedata(cfg.get("auth", "credentials"), cfg.get("gamedata", "spreadsheet_id"))
+    tables = list()
+    for loc_id, loc in gamedata._map.iteritems():
+        tables.append((u"location {}".format(loc_id), loc._events))
+    for venue_id, venue in gamedata._venues.iteritems():
+        tables.append((u"venue {}".format(venue_id), venue._events))
+        for option, _, events in venue._options:
+            tables.append((u"venue {} {}".format(venue_id, option), events))
+    for event_id, texts in gamedata._texts.iteritems():
+        for text_id, (_, options) in texts.iteritems():
+            for option, outcomes in options.iteritems():
+                tables.append((u"text {} {} {}".format(event_id, text_id, option), outcomes))
+    tables.sort(key=lambda table: len(table[1]), reverse=True)
+    return tables[:count]
+
+
+def bench_sampling(args):
+    if args.cfg:
+        tables = load_tables(args.cfg, args.tables)
+    else:
+        tables = make_tables(args.sizes)
+    print("table\toutcomes\tscan us\tbisect us")
+    for name, outcomes in tables:
+        scan_rng, bisect_rng = random.Random(args.seed), random.Random(args.seed)
+        for _ in range(1000):
+            assert scan_outcome(outcomes, scan_rng) is outcomes.choose(bisect_rng)
+        scan = timeit.timeit(lambda: scan_outcome(outcomes, scan_rng),
+                             number=args.number) / args.number
+        choose = timeit.timeit(lambda: outcomes.choose(bisect_rng),
+                               number=args.number) / args.number
+        print(u"{}\t{}\t{:.2f}\t{:.2f}".format(name, len(outcomes), scan * 1e6,
+                                              choose * 1e6).encode("utf8"))
+
+
+def deep_size(obj, seen):
+    """
+    Bytes taken by obj and everything it references that is not in seen
+    yet, adds what it counted to seen.
+    """
+    if id(obj) in seen or isinstance(obj, type):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += deep_size(value, seen)
+    if hasattr(obj, "__dict__"):
+        size += deep_size(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get("__slots__", ()):
+            if name not in ("__weakref__", "__dict__") and hasattr(obj, name):
+                size += deep_size(getattr(obj, name), seen)
+    return size
+
+
+def make_gamedata(locations, items, programs):
+    loc_ids = ["{:03d}".format(index) for index in range(locations)]
+    game_map, venue_map = dict(), dict()
+    for index, loc_id in enumerate(loc_ids):
+        adjacent = dict((dir_id, Transition(loc_ids[(index + step) % locations],
+                                            u"переход", 1.0, u"⬆️", u""))
+                        for step, dir_id in enumerate(sorted(DIR2DIR_ID.values()), 1))
+        venues = [(u"v_{}_{}".format(loc_id, venue), u"объект", 30 * (venue + 1))
+                  for venue in range(3)]
+        for venue_id, _, _ in venues:
+            options = [(u"действие {}".format(option), u"сообщение",
+                        accumulate_probs([(0.5, u"e_0"), (0.5, u"e_1")]))
+                       for option in range(2)]
+            venue_map[venue_id] = Venue(u"объект", options, options[0][2])
+        events = accumulate_probs([(0.25, u"e_{}".format(event)) for event in range(4)])
+        game_map[loc_id] = Location(loc_id, u"описание локации " * 10, 1.0, 10,
+                                    Position(index, index), adjacent, venues, events)
+    item_map = dict((u"i_{}".format(index), Item(u"предмет", u"описание предмета", 1.0))
+                    for index in range(items))
+    program_map = dict((u"p_{}".format(index), Program(u"программа", u"описание", 10, 60, 1))
+                       for index in range(programs))
+    return GameData(game_map, venue_map, dict(), item_map, program_map)
+
+
+def bench_memory(args):
+    if args.cfg:
+        cfg = configparser.RawConfigParser()
+        cfg.read(args.cfg)
+        gamedata = load_gamedata(cfg.get("auth", "credentials"),
+                                 cfg.get("gamedata", "spreadsheet_id"))
+    else:
+        gamedata = make_gamedata(args.locations, args.items, args.programs)
+    seen = set()
+    world = deep_size(gamedata, seen)
+    seen = set()
+    locations = deep_size(gamedata._map, seen)
+    print("world: {} bytes, {} locations, {} bytes per location".format(
+          world, len(gamedata._map), locations / len(gamedata._map)))
+    # players as the cache holds them: loaded from rows, sharing the game
+    # data's objects
+    row = stored_row(make_player(min(args.locations, len(gamedata._map)), args.items).to_row())
+    players = [Player.from_row(row) for _ in range(args.players)]
+    for player in players:
+        player.get_used_cpu(gamedata)
+        player._avatar._backpack.get_weight(gamedata)
+    seen = set()
+    deep_size(gamedata, seen)
+    size = deep_size(players, seen) - sys.getsizeof(players)
+    print("players: {} bytes, {} bytes per player".format(size, size / len(players)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    codec = subparsers.add_parser("codec", help="Player row encode/decode per blob format")
+    codec.add_argument("--locations", type=int, default=300)
+    codec.add_argument("--items", type=int, default=200)
+    codec.add_argument("--number", type=int, default=2000)
+    codec.set_defaults(func=bench_codec)
+
+    sampling = subparsers.add_parser("sampling", help="outcome draws, linear scan vs bisect")
+    sampling.add_argument("--cfg", help="load the largest tables of the spreadsheet in config")
+    sampling.add_argument("--tables", type=int, default=10)
+    sampling.add_argument("--sizes", type=int, nargs="+", default=[5, 20, 100, 1000])
+    sampling.add_argument("--seed", type=int, default=0)
+    sampling.add_argument("--number", type=int, default=100000)
+    sampling.set_defaults(func=bench_sampling)
+
+    memory = subparsers.add_parser("memory", help="bytes per location and per cached player")
+    memory.add_argument("--cfg", help="measure the spreadsheet's world instead of a synthetic one")
+    memory.add_argument("--locations", type=int, default=300)
+    memory.add_argument("--items", type=int, default=200)
+    memory.add_argument("--programs", type=int, default=20)
+    memory.add_argument("--players", type=int, default=1000)
+    memory.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    args.func(args)
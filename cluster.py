@@ -0,0 +1,214 @@
+import json
+import logging
+import select
+import threading
+import time
+
+from telegram import Update
+
+from db import (GAMEDATA_CHANNEL, UPDATES_CHANNEL, delete_updates, fetch_gamedata,
+                fetch_updates, publish_gamedata, push_update)
+from map import dump_snapshot, parse_snapshot
+
+
+def get_partition(user_id, partitions):
+    return user_id % partitions
+
+
+class UpdateRouter(object):
+    """
+    Handler callback of the ingest process: stores every update in the
+    inbox of the worker whose partition owns the update's user.
+    """
+
+    def __init__(self, db, partitions):
+        self._db = db
+        self._partitions = partitions
+
+    def __call__(self, _, update):
+        if update.message is None:
+            return
+        part = get_partition(update.message.from_user.id, self._partitions)
+        with self._db.connect() as conn:
+            push_update(conn, part, json.dumps(update.to_dict()))
+
+
+class Listener(object):
+    """
+    Calls handle(payloads) with the payloads of the NOTIFYs that arrived
+    on channel, in a thread of its own. It is also called with no
+    payloads every poll_interval seconds, in case a notification was
+    missed while the connection was down.
+    """
+
+    def __init__(self, db, channel, handle, poll_interval):
+        self._db = db
+        self._channel = channel
+        self._handle = handle
+        self._poll_interval = poll_interval
+        self._thread = None
+        self._stopped = False
+
+    def is_stopped(self):
+        return self._stopped
+
+    def _run(self):
+        conn = None
+        while not self._stopped:
+            try:
+                if conn is None:
+                    conn = self._db.listen(self._channel)
+                payloads = list()
+                if select.select([conn], [], [], self._poll_interval) != ([], [], []):
+                    conn.poll()
+                    while conn.notifies:
+                        payloads.append(conn.notifies.pop(0).payload)
+                self._handle(payloads)
+            except Exception:
+                logging.exception("LISTENER_FAILED\t{}".format(self._channel))
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                time.sleep(self._poll_interval)
+        if conn is not None:
+            conn.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="listen_{}".format(self._channel))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join()
+
+
+class InboxConsumer(object):
+    """
+    Worker side of UpdateRouter: reads the partition's updates in the
+    order they arrived and feeds them to the dispatcher. The worker must
+    be the only consumer of its partition, or updates of a user may run
+    out of order.
+
+    An update is deleted from the inbox only after its handler has run:
+    a task queued on the user's shard behind the handler marks it
+    handled, and ack() deletes the handled ones. Updates of a worker that
+    crashed are handled again by the next one, so at least once.
+    """
+
+    def __init__(self, db, dispatcher, shards, part, poll_interval=1.0, batch_size=100):
+        self._db = db
+        self._listener = Listener(db, UPDATES_CHANNEL, self._consume, poll_interval)
+        self._dispatcher = dispatcher
+        self._shards = shards
+        self._part = part
+        self._batch_size = batch_size
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._handled = list()
+
+    def _mark_handled(self, update_id):
+        with self._lock:
+            self._handled.append(update_id)
+
+    def ack(self):
+        """
+        Deletes the handled updates. Stop the shards before the last call,
+        so that every dispatched update is handled by then.
+        """
+        with self._lock:
+            handled, self._handled = self._handled, list()
+        if not handled:
+            return
+        try:
+            with self._db.connect() as conn:
+                delete_updates(conn, handled)
+        except Exception:
+            with self._lock:
+                self._handled.extend(handled)
+            raise
+
+    def _consume(self, payloads):
+        self.ack()
+        while not self._listener.is_stopped():
+            with self._db.connect() as conn:
+                rows = fetch_updates(conn, self._part, self._last_id, self._batch_size)
+            for update_id, data in rows:
+                update = Update.de_json(json.loads(data), self._dispatcher.bot)
+                self._dispatcher.process_update(update)
+                user_id = update.message.from_user.id if update.message is not None else None
+                self._shards.submit(user_id, self._mark_handled, update_id)
+                self._last_id = update_id
+            if len(rows) < self._batch_size:
+                return
+
+    def start(self):
+        self._listener.start()
+
+    def stop(self):
+        self._listener.stop()
+
+
+def fetch_published_gamedata(db, known_id=None):
+    """
+    Returns (snapshot id, GameData) of the latest published game data,
+    None if there is none or it is known_id. GameData is None if the
+    snapshot can't be read, e.g. it was written by a build with another
+    SNAPSHOT_VERSION.
+    """
+    with db.connect() as conn:
+        published = fetch_gamedata(conn, known_id)
+    if published is None:
+        return None
+    snapshot_id, data = published
+    try:
+        return snapshot_id, parse_snapshot(data, "GameDataSnapshots {}".format(snapshot_id))
+    except Exception:
+        logging.exception("GAMEDATA_SNAPSHOT_UNREADABLE\t{}".format(snapshot_id))
+        return snapshot_id, None
+
+
+class GameDataBroadcast(object):
+    """
+    Keeps the game data of all workers in step: publish() stores a
+    snapshot in the database and notifies the other workers, which swap
+    it in without validating it again. snapshot_id is the id of the
+    published game data the holder starts with.
+    """
+
+    def __init__(self, db, gamedata_holder, snapshot_id=None, poll_interval=10.0):
+        self._db = db
+        self._listener = Listener(db, GAMEDATA_CHANNEL, lambda payloads: self.fetch(),
+                                  poll_interval)
+        self._gamedata_holder = gamedata_holder
+        self._snapshot_id = snapshot_id
+
+    def publish(self, gamedata):
+        with self._db.connect() as conn:
+            self._snapshot_id = publish_gamedata(conn, dump_snapshot(gamedata))
+        logging.info("GAMEDATA_PUBLISHED\t{}".format(self._snapshot_id))
+
+    def fetch(self):
+        """
+        Swaps in the latest published game data unless it is the current
+        one, returns whether it did.
+        """
+        published = fetch_published_gamedata(self._db, self._snapshot_id)
+        if published is None:
+            return False
+        snapshot_id, gamedata = published
+        # not asked for again until a newer one is published
+        self._snapshot_id = snapshot_id
+        if gamedata is None:
+            return False
+        self._gamedata_holder.swap(gamedata, force=True)
+        logging.info("GAMEDATA_RECEIVED\t{}".format(snapshot_id))
+        return True
+
+    def start(self):
+        self._listener.start()
+
+    def stop(self):
+        self._listener.stop()
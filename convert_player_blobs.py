@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Converts JSON text blob columns of Players to the binary format.
+
+backfill: can run while the bot is up. Adds <column>_BIN BYTEA columns,
+    a trigger that resets them whenever the bot rewrites the JSON column,
+    and converts rows in batches, one transaction per batch.
+swap: run while no bot process is up: stop run.py (and the cluster
+    processes), run swap, set blob_format = binary in [player_db], then
+    start the bot again. restart.sh can't be used for this, the new
+    process starts before the old one stops, and the old one would flush
+    JSON into the binary columns. Refuses to run while a pid file in
+    [restart] pid_dir names a running process. Converts the rows changed
+    since backfill, drops the JSON columns and renames the binary ones.
+"""
+from __future__ import print_function
+import argparse
+import glob
+import os
+try:
+    import configparser
+except:
+    import ConfigParser as configparser
+
+import psycopg2
+
+from db import FIELDS, BLOB_FIELDS, decode_blob, encode_blob, set_blob_format
+from handoff import get_running_pid
+
+BLOB_COLUMNS = [field for field, _ in FIELDS if field in BLOB_FIELDS]
+
+
+def convert_batch(conn, batch_size, skip_locked):
+    stale = " OR ".join("({0}_BIN IS NULL AND {0} IS NOT NULL)".format(field)
+                        for field in BLOB_COLUMNS)
+    with conn.cursor() as curs:
+        curs.execute("SELECT USER_ID, {} FROM Players WHERE {} LIMIT %s FOR UPDATE{}".format(
+                     ", ".join(BLOB_COLUMNS), stale, " SKIP LOCKED" if skip_locked else ""),
+                     (batch_size,))
+        rows = curs.fetchall()
+        for row in rows:
+            values = [encode_blob(decode_blob(value)) if value is not None else None
+                      for value in row[1:]]
+            curs.execute("UPDATE Players SET {} WHERE USER_ID = %s".format(
+                         ", ".join("{}_BIN = %s".format(field) for field in BLOB_COLUMNS)),
+                         values + [row[0]])
+    return len(rows)
+
+
+def backfill(conn, batch_size):
+    with conn.cursor() as curs:
+        for field in BLOB_COLUMNS:
+            curs.execute("ALTER TABLE Players ADD COLUMN IF NOT EXISTS {}_BIN BYTEA".format(field))
+        checks = "\n".join(
+            "IF NEW.{0} IS DISTINCT FROM OLD.{0} THEN NEW.{0}_BIN := NULL; END IF;".format(field)
+            for field in BLOB_COLUMNS)
+        curs.execute("""CREATE OR REPLACE FUNCTION players_blob_reset() RETURNS trigger AS $$
+BEGIN
+{}
+RETURN NEW;
+END
+$$ LANGUAGE plpgsql""".format(checks))
+        curs.execute("DROP TRIGGER IF EXISTS players_blob_reset ON Players")
+        curs.execute("CREATE TRIGGER players_blob_reset BEFORE UPDATE ON Players "
+                     "FOR EACH ROW EXECUTE PROCEDURE players_blob_reset()")
+    conn.commit()
+    total = 0
+    while True:
+        converted = convert_batch(conn, batch_size, True)
+        conn.commit()
+        if converted == 0:
+            break
+        total += converted
+        print("converted {} rows".format(total))
+
+
+def swap(conn, batch_size):
+    with conn.cursor() as curs:
+        curs.execute("LOCK TABLE Players IN ACCESS EXCLUSIVE MODE")
+    total = 0
+    while True:
+        converted = convert_batch(conn, batch_size, False)
+        if converted == 0:
+            break
+        total += converted
+    print("converted {} remaining rows".format(total))
+    with conn.cursor() as curs:
+        curs.execute("DROP TRIGGER players_blob_reset ON Players")
+        curs.execute("DROP FUNCTION players_blob_reset()")
+        for field in BLOB_COLUMNS:
+            curs.execute("ALTER TABLE Players DROP COLUMN {}".format(field))
+            curs.execute("ALTER TABLE Players RENAME COLUMN {0}_BIN TO {0}".format(field))
+    conn.commit()
+    print("done, set blob_format = binary in [player_db]")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("phase", choices=["backfill", "swap"])
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    cfg = configparser.RawConfigParser()
+    cfg.read("config.ini")
+    kwargs = {
+        "host": cfg.get("player_db", "host"),
+        "dbname": cfg.get("player_db", "dbname"),
+        "user": cfg.get("player_db", "user"),
+        "password": cfg.get("player_db", "password")
+    }
+    if args.phase == "swap":
+        pid_dir = cfg.get("restart", "pid_dir") if cfg.has_option("restart", "pid_dir") else "."
+        running = [(pid_file, get_running_pid(pid_file))
+                   for pid_file in sorted(glob.glob(os.path.join(pid_dir, "*.pid")))]
+        running = [(pid_file, pid) for pid_file, pid in running if pid is not None]
+        if running:
+            raise Exception("BOT_RUNNING\t{}: stop it before swap".format(
+                ", ".join("{} ({})".format(pid, pid_file) for pid_file, pid in running)))
+    set_blob_format("binary")
+    conn = psycopg2.connect(**kwargs)
+    try:
+        if args.phase == "backfill":
+            backfill(conn, args.batch_size)
+        else:
+            swap(conn, args.batch_size)
+    finally:
+        conn.close()
@@ -1,20 +1,211 @@
+import cPickle as pickle
+import json
+import logging
+import threading
+import time
+import zlib
+from cStringIO import StringIO
+
 import psycopg2
+from psycopg2.extras import execute_batch
 from telegram import ReplyKeyboardMarkup, KeyboardButton, ParseMode
 
 from constants import *
 
+
+class PooledConnection(object):
+    """
+    What DB.connect() returns. Behaves like psycopg2's `with conn` block
+    (commit on success, rollback on error) but hands the connection back
+    to the pool instead of leaving it open for the garbage collector.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._conn = None
+
+    def __enter__(self):
+        self._conn = self._db._acquire()
+        return self._conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        conn, self._conn = self._conn, None
+        try:
+            if exc_type is None:
+                conn.commit()
+            else:
+                conn.rollback()
+        except psycopg2.Error:
+            self._db._release(conn, broken=True)
+            if exc_type is None:
+                raise
+            return False
+        self._db._release(conn)
+        return False
+
+
 class DB(object):
+    """
+    Bounded, thread-safe pool of long-lived connections.
+
+    min_size: idle connections kept open even past max_idle
+    max_size: hard limit on open connections
+    max_idle: seconds an idle connection may sit in the pool before eviction
+    checkout_timeout: seconds connect() waits for a free connection
+    health_check_interval: connections idle for longer get a `SELECT 1`
+        before being handed out
+    """
 
-    def __init__(self, host, dbname, user, password):
+    def __init__(self, host, dbname, user, password, min_size=1, max_size=8,
+                 max_idle=300, checkout_timeout=10, health_check_interval=30):
         self._host = host
         self._dbname = dbname
         self._user = user
         self._password = password
+        self._min_size = min_size
+        self._max_size = max_size
+        self._max_idle = max_idle
+        self._checkout_timeout = checkout_timeout
+        self._health_check_interval = health_check_interval
+        self._cond = threading.Condition()
+        self._idle = list()
+        self._size = 0
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "max_wait": 0.0,
+            "timeouts": 0,
+            "opened": 0,
+            "evicted": 0,
+            "broken": 0
+        }
 
     def connect(self):
+        return PooledConnection(self)
+
+    def _open(self):
         return psycopg2.connect(host=self._host, user=self._user,
                                 dbname=self._dbname, password=self._password)
 
+    def _is_healthy(self, conn, released_ts):
+        if conn.closed:
+            return False
+        if time.time() - released_ts < self._health_check_interval:
+            return True
+        try:
+            with conn.cursor() as curs:
+                curs.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _evict_idle(self):
+        # idle list is LIFO, the longest idle connections sit at its head
+        evicted = list()
+        deadline = time.time() - self._max_idle
+        while len(self._idle) > self._min_size and self._idle[0][1] < deadline:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            self._stats["evicted"] += 1
+            evicted.append(conn)
+        return evicted
+
+    def _acquire(self):
+        start = time.time()
+        deadline = start + self._checkout_timeout
+        waited = False
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise Exception("DB_POOL_CLOSED")
+                evicted = self._evict_idle()
+                while not self._idle and self._size >= self._max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise Exception("DB_POOL_TIMEOUT: no free connection in {}s".format(
+                                        self._checkout_timeout))
+                    waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, released_ts = self._idle.pop()
+                else:
+                    conn, released_ts = None, None
+                    self._size += 1
+            for stale in evicted:
+                self._discard(stale)
+
+            if conn is None:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats["opened"] += 1
+            elif not self._is_healthy(conn, released_ts):
+                self._release(conn, broken=True)
+                continue
+
+            wait_time = time.time() - start
+            with self._cond:
+                self._stats["checkouts"] += 1
+                if waited:
+                    self._stats["waits"] += 1
+                self._stats["wait_time"] += wait_time
+                self._stats["max_wait"] = max(self._stats["max_wait"], wait_time)
+            return conn
+
+    def _release(self, conn, broken=False):
+        broken = broken or conn.closed
+        with self._cond:
+            if broken or self._closed:
+                self._size -= 1
+                if broken:
+                    self._stats["broken"] += 1
+            else:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+        if broken or self._closed:
+            self._discard(conn)
+
+    def listen(self, channel):
+        conn = self._open()
+        conn.autocommit = True
+        with conn.cursor() as curs:
+            curs.execute("LISTEN {}".format(channel))
+        return conn
+
+    def get_pool_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+        return stats
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, list()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+        logging.info("DB_POOL_CLOSED\t{}".format(self.get_pool_stats()))
+
+INVALIDATE_CHANNEL = "players_invalidate"
+
 FIELDS = [
     ("USER_ID", "INTEGER"),
     ("CHAT_ID", "INTEGER"),
@@ -32,18 +223,287 @@ FIELDS = [
     ("KNOWN_ENTITES", "VARCHAR({})".format(SUGGESTED_ACTIONS_MAX_LEN))
 ]
 
+BLOB_FIELDS = {
+    "SUGGESTED_ACTIONS",
+    "RESEARCH_PERCENT",
+    "RUNNING_SOFT",
+    "KNOWN_SOFT",
+    "COMPILING_SOFT",
+    "INSTALLED_SOFT",
+    "AVATAR",
+    "KNOWN_ENTITES"
+}
+
+# "json" keeps blobs as JSON text in VARCHAR columns, "binary" stores them
+# in BYTEA columns as a version byte followed by the codec payload:
+# pickle protocol 2, which every Python version reads the same way
+BLOB_FORMATS = ("json", "binary")
+BLOB_PICKLE = 1
+BLOB_PICKLE_ZLIB = 2
+BLOB_PICKLE_PROTOCOL = 2
+BLOB_COMPRESS_MIN_LEN = 1024
+
+_blob_format = "json"
+
+
+def set_blob_format(blob_format):
+    global _blob_format
+    assert blob_format in BLOB_FORMATS, "unknown blob format: {}".format(blob_format)
+    _blob_format = blob_format
+
+
+def get_fields(blob_format):
+    assert blob_format in BLOB_FORMATS, "unknown blob format: {}".format(blob_format)
+    if blob_format == "json":
+        return FIELDS
+    return [(field, "BYTEA" if field in BLOB_FIELDS else value_type)
+            for field, value_type in FIELDS]
+
+
+def dump_blob_pickle(value):
+    # blobs are plain data without shared references, so the memo, which
+    # only makes the pickle larger and slower, is off
+    output = StringIO()
+    pickler = pickle.Pickler(output, BLOB_PICKLE_PROTOCOL)
+    pickler.fast = 1
+    pickler.dump(value)
+    return output.getvalue()
+
+
+def encode_blob(value):
+    if _blob_format == "json":
+        if isinstance(value, (set, frozenset)):
+            value = list(value)
+        serialized = json.dumps(value)
+        assert len(serialized) < SUGGESTED_ACTIONS_MAX_LEN
+        return serialized
+    data = dump_blob_pickle(value)
+    if len(data) >= BLOB_COMPRESS_MIN_LEN:
+        return psycopg2.Binary(chr(BLOB_PICKLE_ZLIB) + zlib.compress(data, 1))
+    return psycopg2.Binary(chr(BLOB_PICKLE) + data)
+
+
+def decode_blob(data):
+    """
+    Reads both formats, so rows can be converted while the bot is running.
+    """
+    if data is None:
+        return None
+    if isinstance(data, basestring):
+        return json.loads(data)
+    data = str(data)
+    version = ord(data[0])
+    if version == BLOB_PICKLE:
+        return pickle.loads(data[1:])
+    if version == BLOB_PICKLE_ZLIB:
+        return pickle.loads(zlib.decompress(data[1:]))
+    raise Exception("UNKNOWN_BLOB_VERSION: {}".format(version))
+
 
 def add_player(player, conn):
     with conn.cursor() as curs:
         placeholders = ", ".join(["%s" for field, _ in FIELDS])
-        curs.execute("INSERT INTO Players VALUES ({})".format(placeholders), player.to_row())
+        curs.execute("INSERT INTO Players ({}) VALUES ({})".format(
+                     ", ".join(field for field, _ in FIELDS), placeholders), player.to_row())
+
+
+def update_players(updates, conn):
+    """
+    updates: list of (user_id, column -> serialized value dict), players
+        changing the same set of columns share one batched UPDATE
+    """
+    fields2args = dict()
+    for user_id, columns in updates:
+        fields = tuple(field for field, _ in FIELDS[1:] if field in columns)
+        if fields:
+            fields2args.setdefault(fields, list()).append(
+                [columns[field] for field in fields] + [user_id])
+    with conn.cursor() as curs:
+        for fields, args in fields2args.iteritems():
+            placeholders = ", ".join(["{} = %s".format(field) for field in fields])
+            execute_batch(curs, "UPDATE Players SET {} WHERE USER_ID = %s".format(placeholders),
+                          args)
+
+
+def notify_players_changed(conn, user_ids=None, columns=None):
+    """
+    Tells bot processes to reload players: user_ids, all cached ones if
+    None. Their pending writes of columns are dropped in favour of the
+    edit (see PlayerCache). Without columns that is all pending writes of
+    user_ids, none if user_ids is None as well.
+    """
+    suffix = "".join(":{}".format(column) for column in columns) if columns else ""
+    payload = ",".join("{}{}".format(user_id, suffix)
+                       for user_id in (["*"] if user_ids is None else user_ids))
+    with conn.cursor() as curs:
+        curs.execute("SELECT pg_notify(%s, %s)", (INVALIDATE_CHANNEL, payload))
+
+
+DELAYED_ACTION_FIELDS = [
+    ("PLAYER_ID", "INTEGER"),
+    ("DUE", "DOUBLE PRECISION"),
+    ("ACTION", "VARCHAR({})".format(SUGGESTED_ACTIONS_MAX_LEN))
+]
+
+# DUE is seconds since epoch by the database clock, so that several bot
+# processes agree on what is due
+DB_NOW = "EXTRACT(EPOCH FROM now())"
+
+
+def schedule_action(conn, player_id, delay, action):
+    with conn.cursor() as curs:
+        curs.execute("INSERT INTO DelayedActions (PLAYER_ID, DUE, ACTION) "
+                     "VALUES (%s, {} + %s, %s) ON CONFLICT (PLAYER_ID) "
+                     "DO UPDATE SET DUE = EXCLUDED.DUE, ACTION = EXCLUDED.ACTION".format(DB_NOW),
+                     (player_id, delay, json.dumps(action)))
+
+
+def cancel_action(conn, player_id):
+    with conn.cursor() as curs:
+        curs.execute("DELETE FROM DelayedActions WHERE PLAYER_ID = %s", (player_id,))
+        return curs.rowcount > 0
+
+
+def get_action(conn, player_id):
+    with conn.cursor() as curs:
+        curs.execute("SELECT DUE, ACTION FROM DelayedActions WHERE PLAYER_ID = %s", (player_id,))
+        rows = curs.fetchall()
+    if rows:
+        return rows[0][0], tuple(json.loads(rows[0][1]))
+
+
+def claim_due_actions(conn, limit, lease, partition=None):
+    """
+    Claims up to limit due actions of the partition's players and returns
+    (player_id, due, action) triples. A claim is a lease: it moves DUE
+    lease seconds ahead, so an action that is not finished by then, e.g.
+    because its process died, becomes due again. Rows locked by another
+    process's claim are skipped, not waited for.
+    """
+    condition, args = get_partition_filter("PLAYER_ID", partition)
+    with conn.cursor() as curs:
+        curs.execute("UPDATE DelayedActions SET DUE = {0} + %s WHERE PLAYER_ID IN ("
+                     "SELECT PLAYER_ID FROM DelayedActions WHERE DUE <= {0} AND {1} "
+                     "ORDER BY DUE LIMIT %s FOR UPDATE SKIP LOCKED) "
+                     "RETURNING PLAYER_ID, DUE, ACTION".format(DB_NOW, condition),
+                     (lease,) + args + (limit,))
+        rows = curs.fetchall()
+    return [(player_id, due, tuple(json.loads(action))) for player_id, due, action in rows]
+
+
+def finish_action(conn, player_id, due):
+    """
+    Deletes a claimed action unless the player has been given a new one
+    since (while it ran, most likely).
+    """
+    with conn.cursor() as curs:
+        curs.execute("DELETE FROM DelayedActions WHERE PLAYER_ID = %s AND DUE = %s",
+                     (player_id, due))
+
+
+def get_action_delays(conn, partition=None):
+    condition, args = get_partition_filter("PLAYER_ID", partition)
+    with conn.cursor() as curs:
+        curs.execute("SELECT DUE - {} FROM DelayedActions WHERE {}".format(DB_NOW, condition),
+                     args)
+        return [row[0] for row in curs.fetchall()]
+
+
+INBOX_FIELDS = [
+    ("ID", "BIGSERIAL"),
+    ("PART", "INTEGER"),
+    ("DATA", "TEXT")
+]
+UPDATES_CHANNEL = "updates"
+
+GAMEDATA_FIELDS = [
+    ("ID", "SERIAL"),
+    ("DATA", "BYTEA")
+]
+GAMEDATA_CHANNEL = "gamedata"
+
+
+def get_partition_filter(column, partition):
+    """
+    partition: (index, count) or None for all rows
+    """
+    if partition is None:
+        return "TRUE", ()
+    index, count = partition
+    return "{} %% %s = %s".format(column), (count, index)
+
+
+def push_update(conn, part, data):
+    with conn.cursor() as curs:
+        curs.execute("INSERT INTO Inbox (PART, DATA) VALUES (%s, %s)", (part, data))
+        curs.execute("SELECT pg_notify(%s, %s)", (UPDATES_CHANNEL, str(part)))
+
+
+def fetch_updates(conn, part, after_id, limit):
+    """
+    Returns up to limit (id, serialized update) pairs of the partition
+    with ids greater than after_id, in the order they were pushed. They
+    stay in the inbox until delete_updates.
+    """
+    with conn.cursor() as curs:
+        curs.execute("SELECT ID, DATA FROM Inbox WHERE PART = %s AND ID > %s "
+                     "ORDER BY ID LIMIT %s", (part, after_id, limit))
+        return curs.fetchall()
+
+
+def delete_updates(conn, update_ids):
+    with conn.cursor() as curs:
+        curs.execute("DELETE FROM Inbox WHERE ID = ANY(%s)", (list(update_ids),))
+
+
+def publish_gamedata(conn, data):
+    with conn.cursor() as curs:
+        curs.execute("INSERT INTO GameDataSnapshots (DATA) VALUES (%s) RETURNING ID",
+                     (psycopg2.Binary(data),))
+        snapshot_id = curs.fetchone()[0]
+        curs.execute("DELETE FROM GameDataSnapshots WHERE ID < %s", (snapshot_id,))
+        curs.execute("SELECT pg_notify(%s, %s)", (GAMEDATA_CHANNEL, str(snapshot_id)))
+    return snapshot_id
+
+
+def fetch_gamedata(conn, known_id=None):
+    """
+    Returns (id, data) of the latest published snapshot, None if there is
+    none or its id is known_id.
+    """
+    with conn.cursor() as curs:
+        curs.execute("SELECT ID, DATA FROM GameDataSnapshots "
+                     "WHERE ID = (SELECT MAX(ID) FROM GameDataSnapshots) "
+                     "AND ID IS DISTINCT FROM %s", (known_id,))
+        rows = curs.fetchall()
+    if rows:
+        return rows[0][0], str(rows[0][1])
+
+
+ENTITY_ID_FIELDS = [
+    ("ENTITY_ID", "VARCHAR(100)"),
+    ("IDX", "SERIAL UNIQUE")
+]
+
+
+def register_entity_ids(conn, entity_ids):
+    """
+    Gives the entity ids that have no index yet the next free ones,
+    returns (entity_id, index) pairs of all entity_ids.
+    """
+    with conn.cursor() as curs:
+        execute_batch(curs, "INSERT INTO EntityIds (ENTITY_ID) VALUES (%s) "
+                      "ON CONFLICT (ENTITY_ID) DO NOTHING",
+                      [(entity_id,) for entity_id in entity_ids])
+        curs.execute("SELECT ENTITY_ID, IDX FROM EntityIds WHERE ENTITY_ID = ANY(%s)",
+                     (list(entity_ids),))
+        return curs.fetchall()
 
 
-def update_player(player, conn):
+def get_entity_ids(conn):
     with conn.cursor() as curs:
-        placeholders = ", ".join(["{} = %s".format(field) for field, _ in FIELDS[1:]])
-        curs.execute("UPDATE Players SET {} WHERE USER_ID = %s".format(placeholders),
-                     player.to_row()[1:] + [player._user_id])
+        curs.execute("SELECT ENTITY_ID, IDX FROM EntityIds")
+        return curs.fetchall()
 
 
 def make_keyboard_markup(table):
@@ -51,12 +511,19 @@ def make_keyboard_markup(table):
         return ReplyKeyboardMarkup([[KeyboardButton(text) for _, text in row] for row in table], True)
 
 
-def send_message(player, conn, bot, text, keyboard=None):
+def send_message(player, players, bot, text, keyboard=None, keyboard_id=None, markup=None,
+                 suggested_actions=None):
+    """
+    markup and suggested_actions can be passed if they were built for
+    keyboard beforehand, both are treated as read-only.
+    """
     chat_id = player._chat_id
     if keyboard is None:
         bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
         return
-    player.set_actions(keyboard)
-    update_player(player, conn)
-    bot.send_message(chat_id, text, parse_mode=ParseMode.HTML,
-                         reply_markup=make_keyboard_markup(keyboard))
+    assert keyboard_id is not None, "keyboard without keyboard_id"
+    player.set_keyboard(keyboard_id, keyboard, suggested_actions)
+    players.update(player)
+    if markup is None:
+        markup = make_keyboard_markup(keyboard)
+    bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, reply_markup=markup)
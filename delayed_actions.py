@@ -1,25 +1,135 @@
-from heapq import heappop
+import heapq
+import logging
+import threading
 import time
 
-def run_routine(bot, players, gamedata):
-    while True:
-        if not bot.delayed_actions:
-            time.sleep(0.01)
-            continue
-        with bot.delayed_action_lock:
-            ts, count, player_id = bot.delayed_actions[0]
-            if ts > time.time():
-                continue
-            heappop(bot.delayed_actions)
-        action = players[player_id]._delayed_action
-        print action
-        if action is None:
-            continue
-        fullfill_time = players[player_id]._fullfill_time
-        print fullfill_time
-        if fullfill_time is None:
-            continue
-        if fullfill_time != ts:
-            assert fullfill_time > ts
-            continue
-        players[player_id].do_action(action, bot, gamedata)
+from db import (cancel_action, claim_due_actions, finish_action, get_action, get_action_delays,
+                schedule_action)
+
+
+class Scheduler(object):
+    """
+    Delayed player actions, at most one pending action per player.
+
+    Actions live in the DelayedActions table (see init_delayed_actions.py),
+    so they survive restarts and can be shared by several bot processes.
+    schedule() replaces the player's pending action, cancel() drops it.
+
+    The timer thread sleeps on a condition until the earliest deadline
+    this process knows of, but at most poll_interval seconds to pick up
+    actions scheduled by other processes, then claims due actions in
+    batches of batch_size. Claimed actions run on the player's shard, in
+    order with the player's updates. With partition = (index, count) only
+    actions of players with player_id % count == index are claimed.
+
+    A claimed action stays in the table, due again in lease seconds, and
+    is deleted once it has run. An action claimed by a process that dies
+    first runs after the lease ends; lease must exceed how long claimed
+    actions may wait on the shards, or they run twice.
+    """
+
+    def __init__(self, bot, players, gamedata_holder, shards, poll_interval=1.0,
+                 batch_size=100, lease=300.0, partition=None):
+        self._bot = bot
+        self._players = players
+        self._gamedata_holder = gamedata_holder
+        self._shards = shards
+        self._partition = partition
+        self._poll_interval = poll_interval
+        self._batch_size = batch_size
+        self._lease = lease
+        self._cond = threading.Condition()
+        # local deadlines, only used to wake up the timer on time
+        self._heap = list()
+        self._thread = None
+        self._stopped = False
+
+    def _add_deadline(self, ts):
+        with self._cond:
+            heapq.heappush(self._heap, ts)
+            if self._heap[0] == ts:
+                self._cond.notify()
+
+    def schedule(self, player_id, delay, action):
+        with self._players.connect() as conn:
+            schedule_action(conn, player_id, delay, action)
+        ts = time.time() + delay
+        self._add_deadline(ts)
+        return ts
+
+    def cancel(self, player_id):
+        with self._players.connect() as conn:
+            return cancel_action(conn, player_id)
+
+    def get_pending(self, player_id):
+        with self._players.connect() as conn:
+            return get_action(conn, player_id)
+
+    def _wait(self):
+        with self._cond:
+            deadline = time.time() + self._poll_interval
+            while not self._stopped:
+                now = time.time()
+                while self._heap and self._heap[0] <= now:
+                    heapq.heappop(self._heap)
+                    deadline = now
+                if now >= deadline:
+                    return True
+                self._cond.wait(min([deadline] + self._heap[:1]) - now)
+            return False
+
+    def _claim(self):
+        while True:
+            with self._players.connect() as conn:
+                claimed = claim_due_actions(conn, self._batch_size, self._lease,
+                                            self._partition)
+            for player_id, due, action in claimed:
+                self._shards.submit(player_id, self._run_action, player_id, due, action)
+            if len(claimed) < self._batch_size:
+                return
+
+    def _run_timer(self):
+        while self._wait():
+            try:
+                self._claim()
+            except Exception:
+                logging.exception("DELAYED_ACTION_CLAIM_FAILED")
+
+    def _run_action(self, player_id, due, action):
+        try:
+            player = self._players.fetch(player_id)
+            if player is None:
+                logging.warning("DELAYED_ACTION_UNKNOWN_PLAYER\t{}".format(player_id))
+            else:
+                player.do_action(action, self._bot, self._gamedata_holder.get(), self._players)
+        except Exception:
+            logging.exception("DELAYED_ACTION_FAILED\t{}\t{}".format(player_id, action))
+        try:
+            # a failed action is dropped as well, only a dead process retries
+            with self._players.connect() as conn:
+                finish_action(conn, player_id, due)
+        except Exception:
+            logging.exception("DELAYED_ACTION_FINISH_FAILED\t{}\t{}".format(player_id, action))
+
+    def start(self):
+        with self._players.connect() as conn:
+            delays = get_action_delays(conn, self._partition)
+        now = time.time()
+        for delay in delays:
+            self._add_deadline(now + delay)
+        logging.info("DELAYED_ACTIONS_LOADED\t{}".format(len(delays)))
+        self._thread = threading.Thread(target=self._run_timer, name="scheduler_timer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Actions that are not due yet stay in the table for the next start.
+        Claimed ones are already queued on the shards, stop the shards
+        after the scheduler to run and finish them.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# coding: utf8
+"""
+Local stand-in for the Google Sheets API to check the game data loader
+without a spreadsheet. FakeSheets serves a generated spreadsheet through
+spreadsheets().get, values().batchGet and values().get and can fail the
+next requests on purpose. Running this script loads the game data
+through it with map.load_gamedata and checks that transient errors are
+retried and that permanent errors and short batchGet answers fail the
+load instead of giving partial game data.
+"""
+from __future__ import print_function
+import argparse
+import logging
+import socket
+import sys
+import threading
+import time
+
+from httplib2 import Response
+from apiclient.errors import HttpError
+
+import map as gamedata_module
+
+# a failure is an http status, SOCKET for a connection error or SHORT
+# for a batchGet answer with the last range missing
+SOCKET = "socket"
+SHORT = "short"
+
+
+def make_location_sheet(loc_id, next_id, venue_id):
+    rows = [[u"глобальная карта", u"основное"], [u"локация {}".format(loc_id)],
+            [u"размер квадрата", u"1", u"скорость исследования", u"10"],
+            [u"X", u"0"], [u"Y", u"0"], [],
+            [u"выходы", u"условие", u"переход на", u"множитель", u"описание процесса перехода"]]
+    for direction in [u"север", u"СВ", u"восток", u"ЮВ", u"юг", u"ЮЗ", u"запад", u"СЗ"]:
+        rows.append([direction, u"", next_id, u"1", u"идём", u"→"])
+    rows += [[], [], [u"постоянные объекты"], [venue_id, u"0%", u"бар"],
+             [u"случайные ивенты"], [venue_id, u"100%"]]
+    return {"values": rows}
+
+
+def make_spreadsheet(locations):
+    loc_ids = [u"{:03d}".format(index) for index in range(1, locations + 1)]
+    sheets = dict()
+    for index, loc_id in enumerate(loc_ids):
+        sheets[loc_id] = make_location_sheet(loc_id, loc_ids[(index + 1) % len(loc_ids)],
+                                             u"v{}".format(index % 2 + 1))
+    sheets[u"локации"] = {"values": [
+        [u"venue"],
+        [u"v1"],
+        [u"", u"Бар", u"пить", u"Пьём", u"", u"100%", u"e1"],
+        [u"", u"исследование", u"смотреть", u"", u"", u"100%", u"e1"],
+        [u"v2"],
+        [u"", u"Лес", u"рубить", u"", u"", u"100%", u"e1"]]}
+    sheets[u"тексты"] = {"values": [
+        [u"event"],
+        [u"", u"e1"],
+        [u"t1", u"Событие", u"", u"", u"", u"да", u"100%", u"1", u"ок", u"i_1"]]}
+    sheets[u"Ресурсы"] = {"values": [[u"item"], [u"item"], [u"i_1", u"Камень", u"камень", u"1"]]}
+    sheets[u"программы"] = {"values": [[u"program"], [u"p1", u"Прога", u"описание", u"1", u"1", u"1"]]}
+    return sheets
+
+
+def parse_range(value_range):
+    # "'title'" as quoted by map.quote_sheet_title, or a bare title
+    if value_range.startswith(u"'") and value_range.endswith(u"'"):
+        return value_range[1:-1].replace(u"''", u"'")
+    return value_range
+
+
+class FakeRequest(object):
+
+    def __init__(self, service, method, answer):
+        self._service = service
+        self._method = method
+        self._answer = answer
+
+    def execute(self):
+        failure = self._service.start_request(self._method)
+        if failure is None:
+            return self._answer()
+        if failure == SOCKET:
+            raise socket.error("fake connection reset")
+        if failure == SHORT:
+            result = self._answer()
+            result["valueRanges"] = result["valueRanges"][:-1]
+            return result
+        raise HttpError(Response({"status": failure}), "fake error {}".format(failure))
+
+
+class FakeValues(object):
+
+    def __init__(self, service):
+        self._service = service
+
+    def batchGet(self, spreadsheetId, ranges):
+        return FakeRequest(self._service, "batchGet", lambda: {
+            "spreadsheetId": spreadsheetId,
+            "valueRanges": [self._service.get_values(value_range) for value_range in ranges]})
+
+    def get(self, spreadsheetId, range):
+        return FakeRequest(self._service, "values.get", lambda: self._service.get_values(range))
+
+
+class FakeSpreadsheets(object):
+
+    def __init__(self, service):
+        self._service = service
+
+    def get(self, spreadsheetId, ranges=None, includeGridData=False):
+        assert not includeGridData, "the loader only needs sheet titles"
+        return FakeRequest(self._service, "get", lambda: {
+            "spreadsheetId": spreadsheetId,
+            "sheets": [{"properties": {"title": title}}
+                       for title in sorted(self._service._sheets)]})
+
+    def values(self):
+        return FakeValues(self._service)
+
+
+class FakeSheets(object):
+    """
+    Serves sheets (title -> {"values": rows}) like a Sheets v4 service.
+    Every request waits latency seconds. fail(method, failures) makes the
+    next requests of that method fail, one failure per request.
+    """
+
+    def __init__(self, sheets, latency=0.0):
+        self._sheets = sheets
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._failures = dict()
+        self._requests = dict()
+
+    def spreadsheets(self):
+        return FakeSpreadsheets(self)
+
+    def fail(self, method, failures):
+        with self._lock:
+            self._failures.setdefault(method, list()).extend(failures)
+
+    def start_request(self, method):
+        with self._lock:
+            self._requests[method] = self._requests.get(method, 0) + 1
+            failures = self._failures.get(method)
+            failure = failures.pop(0) if failures else None
+        time.sleep(self._latency)
+        return failure
+
+    def get_requests(self, method):
+        with self._lock:
+            return self._requests.get(method, 0)
+
+    def get_values(self, value_range):
+        title = parse_range(value_range)
+        if title not in self._sheets:
+            raise HttpError(Response({"status": 400}), "unable to parse range: {}".format(
+                value_range.encode("utf8")))
+        return dict(self._sheets[title], range=value_range)
+
+
+def load_per_sheet(service, spreadsheet_id):
+    # how the game data was fetched before batchGet: one request per sheet
+    response = service.spreadsheets().get(spreadsheetId=spreadsheet_id, ranges=[],
+                                          includeGridData=False).execute()
+    return dict((sheet["properties"]["title"], service.spreadsheets().values().get(
+                 spreadsheetId=spreadsheet_id,
+                 range=gamedata_module.quote_sheet_title(sheet["properties"]["title"])).execute())
+                for sheet in response["sheets"])
+
+
+class Checker(object):
+
+    def __init__(self, sheets, latency, chunk_size, threads, retries):
+        self._sheets = sheets
+        self._latency = latency
+        self._options = dict(chunk_size=chunk_size, threads=threads, retries=retries)
+        self._chunks = (len(sheets) + chunk_size - 1) // chunk_size
+        self._failed = 0
+
+    def load(self, failures=None):
+        service = FakeSheets(self._sheets, self._latency)
+        for method, method_failures in (failures or dict()).iteritems():
+            service.fail(method, method_failures)
+        start = time.time()
+        try:
+            gamedata = gamedata_module.load_gamedata(None, "fake", make_service=lambda: service,
+                                                     **self._options)
+        except Exception as e:
+            return service, None, e, time.time() - start
+        return service, gamedata, None, time.time() - start
+
+    def report(self, name, ok, details):
+        if not ok:
+            self._failed += 1
+        print("{}\t{}\t{}".format("OK" if ok else "FAIL", name, details))
+
+    def check_loaded(self, name, failures, extra_requests):
+        service, gamedata, error, elapsed = self.load(failures)
+        if error is not None:
+            self.report(name, False, "load failed: {!r}".format(error))
+            return
+        requests = service.get_requests("batchGet")
+        missing = gamedata_module.check_gamedata(gamedata)
+        expected = len([title for title in self._sheets if title.isnumeric()])
+        self.report(name, len(gamedata._map) == expected and not any(missing)
+                    and requests == self._chunks + extra_requests,
+                    "{} locations, {} batchGet requests, {:.2f}s".format(
+                        len(gamedata._map), requests, elapsed))
+
+    def check_failed(self, name, failures, error_type):
+        _, gamedata, error, elapsed = self.load(failures)
+        self.report(name, gamedata is None and isinstance(error, error_type),
+                    "raised {!r} in {:.2f}s".format(error, elapsed))
+
+    def run(self):
+        retries = self._options["retries"]
+        self.check_loaded("clean", None, 0)
+        self.check_loaded("transient errors are retried",
+                          {"get": [503], "batchGet": [503, 429, SOCKET]}, 3)
+        self.check_failed("permanent error fails the load", {"batchGet": [403]}, HttpError)
+        # requests run in parallel, with this many failures some chunk gets retries + 1
+        self.check_failed("retries run out", {"batchGet": [503] * (retries + 1) * self._chunks},
+                          HttpError)
+        self.check_failed("short batchGet fails the load", {"batchGet": [SHORT]}, AssertionError)
+
+        service = FakeSheets(self._sheets, self._latency)
+        start = time.time()
+        load_per_sheet(service, "fake")
+        print("per sheet values().get: {} requests, {:.2f}s".format(
+              service.get_requests("values.get"), time.time() - start))
+        return self._failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--locations", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per request")
+    parser.add_argument("--chunk-size", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    checker = Checker(make_spreadsheet(args.locations), args.latency, args.chunk_size,
+                      args.threads, args.retries)
+    failed = checker.run()
+    print("{} checks failed".format(failed) if failed else "all checks passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# coding: utf8
+"""
+Local stand-in for the Telegram Bot API to load test the bot without
+Telegram. Set base_url = http://127.0.0.1:<port>/bot in [telegram] and
+run the bot in polling or webhook mode, the latter with webhook_url set
+to http://127.0.0.1:<bot port>/<url_path>. Then run this script:
+simulated users send /start and walk the map, each waiting for the
+bot's reply before sending the next message. Prints reply latencies at
+the end.
+"""
+from __future__ import print_function
+import argparse
+import json
+import logging
+import threading
+import time
+import urllib2
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+BOT_ID = 1
+# /restart answers existing users, /start new ones
+SCRIPT = [[u"/restart", u"/start"], [u"Продолжить"]]
+WALK = [u"🔄"]
+
+
+class FakeTelegram(object):
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._updates = list()
+        self._update_id = 0
+        self._message_id = 0
+        self._webhook_url = None
+        self._webhook_queue = list()
+        # chat_id -> number of messages the bot sent to it
+        self._sent = dict()
+
+    def _next_message_id(self):
+        self._message_id += 1
+        return self._message_id
+
+    def push_text(self, user_id, text):
+        with self._cond:
+            self._update_id += 1
+            message = {
+                "message_id": self._next_message_id(),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "first_name": "user{}".format(user_id), "is_bot": False},
+                "text": text
+            }
+            if text.startswith(u"/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0,
+                                        "length": len(text.split()[0])}]
+            update = {"update_id": self._update_id, "message": message}
+            if self._webhook_url is None:
+                self._updates.append(update)
+            else:
+                self._webhook_queue.append(update)
+            self._cond.notify_all()
+
+    def get_sent(self, chat_id):
+        with self._cond:
+            return self._sent.get(chat_id, 0)
+
+    def wait_sent(self, chat_id, count, timeout):
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._sent.get(chat_id, 0) < count:
+                now = time.time()
+                if now >= deadline:
+                    return False
+                self._cond.wait(deadline - now)
+            return True
+
+    def call(self, method, params):
+        if method == "getMe":
+            return {"id": BOT_ID, "first_name": "bot", "is_bot": True, "username": "fake_bot"}
+        if method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            deadline = time.time() + float(params.get("timeout") or 0)
+            with self._cond:
+                self._updates = [update for update in self._updates
+                                 if update["update_id"] >= offset]
+                while not self._updates and time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+                limit = int(params.get("limit") or 100)
+                return self._updates[:limit]
+        if method == "setWebhook":
+            with self._cond:
+                self._webhook_url = params.get("url") or None
+                self._cond.notify_all()
+            return True
+        if method == "deleteWebhook":
+            with self._cond:
+                self._webhook_url = None
+            return True
+        if method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            with self._cond:
+                self._sent[chat_id] = self._sent.get(chat_id, 0) + 1
+                self._cond.notify_all()
+                return {"message_id": self._next_message_id(), "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"},
+                        "text": params.get("text", u"")}
+        if method == "sendChatAction":
+            return True
+        raise Exception("UNSUPPORTED_METHOD\t{}".format(method))
+
+    def run_webhook_pusher(self):
+        while True:
+            with self._cond:
+                while not self._webhook_queue:
+                    self._cond.wait()
+                url = self._webhook_url
+                batch, self._webhook_queue = self._webhook_queue, list()
+            for update in batch:
+                request = urllib2.Request(url, json.dumps(update),
+                                          {"Content-Type": "application/json"})
+                try:
+                    urllib2.urlopen(request, timeout=10).read()
+                except Exception:
+                    logging.exception("WEBHOOK_POST_FAILED\t{}".format(url))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(telegram):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _handle(self, body):
+            url = urlparse.urlparse(self.path)
+            method = url.path.rsplit("/", 1)[-1]
+            params = dict(urlparse.parse_qsl(url.query))
+            if body:
+                if self.headers.getheader("content-type", "").startswith("application/json"):
+                    params.update(json.loads(body))
+                else:
+                    params.update(urlparse.parse_qsl(body))
+            try:
+                response = {"ok": True, "result": telegram.call(method, params)}
+                status = 200
+            except Exception as e:
+                response = {"ok": False, "error_code": 400, "description": str(e)}
+                status = 400
+            data = json.dumps(response)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._handle(None)
+
+        def do_POST(self):
+            self._handle(self.rfile.read(int(self.headers.getheader("content-length", 0))))
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def run_user(telegram, user_id, messages, timeout, latencies, lock):
+    steps = SCRIPT + [WALK] * messages
+    for texts in steps:
+        count = telegram.get_sent(user_id)
+        start = time.time()
+        for text in texts:
+            telegram.push_text(user_id, text)
+        replied = telegram.wait_sent(user_id, count + 1, timeout)
+        with lock:
+            latencies.append(time.time() - start if replied else None)
+        # let the rest of the replies to this step arrive
+        time.sleep(0.05)
+
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20, help="map walks per user")
+    parser.add_argument("--first-user-id", type=int, default=1000000)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=5.0,
+                        help="seconds to let the bot connect before sending")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    telegram = FakeTelegram()
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(telegram))
+    for target in [server.serve_forever, telegram.run_webhook_pusher]:
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    print("fake Telegram on http://127.0.0.1:{}/bot".format(args.port))
+    time.sleep(args.warmup)
+
+    latencies = list()
+    lock = threading.Lock()
+    start = time.time()
+    users = [threading.Thread(target=run_user,
+                              args=(telegram, args.first_user_id + index, args.messages,
+                                    args.timeout, latencies, lock))
+             for index in range(args.users)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.time() - start
+
+    answered = sorted(latency for latency in latencies if latency is not None)
+    print("steps {}, unanswered {}, {:.1f} steps/s".format(
+          len(latencies), len(latencies) - len(answered), len(latencies) / elapsed))
+    if answered:
+        print("latency ms: avg {:.1f}, p50 {:.1f}, p95 {:.1f}, max {:.1f}".format(
+              1000 * sum(answered) / len(answered), 1000 * percentile(answered, 0.5),
+              1000 * percentile(answered, 0.95), 1000 * answered[-1]))
+    server.shutdown()
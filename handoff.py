@@ -0,0 +1,88 @@
+import errno
+import logging
+import os
+import signal
+import time
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def is_bot_process(pid):
+    """
+    Whether pid runs run.py. Without /proc (not Linux) only whether it
+    runs at all.
+    """
+    try:
+        with open("/proc/{}/cmdline".format(pid)) as f:
+            args = f.read().split("\0")
+    except IOError:
+        return not os.path.isdir("/proc") and is_running(pid)
+    return any(os.path.basename(arg) == "run.py" for arg in args)
+
+
+def read_pid(pid_file):
+    try:
+        with open(pid_file) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def get_running_pid(pid_file):
+    """
+    The pid recorded in pid_file if that process is a running bot, else
+    None. After a crash the pid of a stale pid file may have been reused
+    by an unrelated process, which must not get our SIGTERM.
+    """
+    pid = read_pid(pid_file)
+    if pid is None or not is_running(pid):
+        return None
+    if not is_bot_process(pid):
+        logging.warning("PID_FILE_STALE\t{}\t{} is not run.py".format(pid_file, pid))
+        return None
+    return pid
+
+
+class Handoff(object):
+    """
+    Graceful restart through a pid file.
+
+    A new process warms up first, then take_over() sends SIGTERM to the
+    process recorded in pid_file if that is still a running run.py (see
+    get_running_pid), waits until it has drained its queues, flushed its
+    players and exited, and records its own pid. Only then does the new
+    process start taking updates, so no update is served by both or by
+    neither. release() removes the pid file on exit unless
+    another process has taken over already.
+    """
+
+    def __init__(self, pid_file, timeout=120.0):
+        self._pid_file = pid_file
+        self._timeout = timeout
+
+    def take_over(self):
+        pid = get_running_pid(self._pid_file)
+        if pid is not None and pid != os.getpid():
+            logging.info("HANDOFF_STOPPING\t{}".format(pid))
+            start = time.time()
+            os.kill(pid, signal.SIGTERM)
+            while is_running(pid):
+                if time.time() - start > self._timeout:
+                    # the old process keeps serving, this one gives up
+                    raise Exception("HANDOFF_TIMEOUT\t{}".format(pid))
+                time.sleep(0.1)
+            logging.info("HANDOFF_STOPPED\t{}\t{:.1f}s".format(pid, time.time() - start))
+        tmp = "{}.{}".format(self._pid_file, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(str(os.getpid()))
+        os.rename(tmp, self._pid_file)
+
+    def release(self):
+        if read_pid(self._pid_file) == os.getpid():
+            os.remove(self._pid_file)
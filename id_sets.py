@@ -0,0 +1,160 @@
+import logging
+import threading
+
+from db import decode_blob, encode_blob, get_entity_ids, register_entity_ids
+from map import intern_id
+
+
+def normalize_id(entity_id):
+    # ids come back from psycopg2 as utf8 str, from the sheets as unicode
+    return entity_id.decode("utf8") if isinstance(entity_id, str) else entity_id
+
+
+class IdRegistry(object):
+    """
+    Stable entity id -> bit index mapping for IdSet. An id keeps its index
+    forever, ids new to a sheet version get the next free ones, so stored
+    bitsets stay valid across reloads. Indexes live in the EntityIds
+    table (see init_entity_ids.py) and are shared by all bot processes;
+    without db they are only kept in memory.
+    """
+
+    def __init__(self, db=None):
+        self._db = db
+        self._lock = threading.Lock()
+        self._indexes = dict()
+        self._ids = dict()
+
+    def _add(self, pairs):
+        for entity_id, index in pairs:
+            entity_id = intern_id(normalize_id(entity_id))
+            self._indexes[entity_id] = index
+            self._ids[index] = entity_id
+
+    def load(self):
+        if self._db is None:
+            return
+        with self._db.connect() as conn:
+            pairs = get_entity_ids(conn)
+        with self._lock:
+            self._add(pairs)
+        logging.info("ENTITY_IDS_LOADED\t{}".format(len(pairs)))
+
+    def register(self, entity_ids):
+        with self._lock:
+            missing = sorted(set(normalize_id(entity_id) for entity_id in entity_ids
+                                 if entity_id not in self._indexes))
+            if not missing:
+                return
+            if self._db is None:
+                start = max(self._ids) + 1 if self._ids else 0
+                self._add([(entity_id, start + index) for index, entity_id in enumerate(missing)])
+                return
+            with self._db.connect() as conn:
+                self._add(register_entity_ids(conn, missing))
+
+    def find_index(self, entity_id):
+        return self._indexes.get(entity_id)
+
+    def get_index(self, entity_id):
+        index = self._indexes.get(entity_id)
+        if index is None:
+            self.register([entity_id])
+            index = self._indexes[normalize_id(entity_id)]
+        return index
+
+    def get_id(self, index):
+        entity_id = self._ids.get(index)
+        if entity_id is None:
+            # registered by another process since load()
+            self.load()
+            entity_id = self._ids.get(index)
+            if entity_id is None:
+                raise Exception("UNKNOWN_ENTITY_INDEX\t{}".format(index))
+        return entity_id
+
+
+_registry = IdRegistry()
+
+
+def set_registry(registry):
+    global _registry
+    _registry = registry
+
+
+def get_registry():
+    return _registry
+
+
+def register_gamedata_ids(gamedata):
+    _registry.register(sorted(gamedata._items) + sorted(gamedata._programs))
+
+
+class IdSet(object):
+    """
+    Set of entity ids kept as a bitset over the registry's indexes: an
+    int in memory, its hex digits in the database.
+    """
+    __slots__ = ("_bits",)
+
+    def __init__(self, entity_ids=(), bits=0):
+        for entity_id in entity_ids:
+            bits |= 1 << _registry.get_index(entity_id)
+        self._bits = bits
+
+    def __contains__(self, entity_id):
+        index = _registry.find_index(entity_id)
+        return index is not None and bool(self._bits & (1 << index))
+
+    def __iter__(self):
+        for index, bit in enumerate(reversed(bin(self._bits)[2:])):
+            if bit == "1":
+                yield _registry.get_id(index)
+
+    def __len__(self):
+        return bin(self._bits).count("1")
+
+    def __nonzero__(self):
+        return self._bits != 0
+
+    def __eq__(self, other):
+        return isinstance(other, IdSet) and self._bits == other._bits
+
+    __hash__ = None
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __and__(self, other):
+        return IdSet(bits=self._bits & other._bits)
+
+    def __sub__(self, other):
+        return IdSet(bits=self._bits & ~other._bits)
+
+    def __repr__(self):
+        return "IdSet({!r})".format(sorted(self))
+
+    def add(self, entity_id):
+        self._bits |= 1 << _registry.get_index(entity_id)
+
+    def discard(self, entity_id):
+        index = _registry.find_index(entity_id)
+        if index is not None:
+            self._bits &= ~(1 << index)
+
+    def remove(self, entity_id):
+        if entity_id not in self:
+            raise KeyError(entity_id)
+        self.discard(entity_id)
+
+
+def encode_id_set(value):
+    return encode_blob(format(value._bits, "x"))
+
+
+def decode_id_set(data):
+    value = decode_blob(data)
+    if isinstance(value, basestring):
+        return IdSet(bits=int(value, 16))
+    # written before the bitsets: a list of ids
+    return IdSet(value)
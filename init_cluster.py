@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+try:
+    import configparser
+except:
+    import ConfigParser as configparser
+
+import psycopg2
+
+from db import GAMEDATA_FIELDS, INBOX_FIELDS
+
+cfg = configparser.RawConfigParser()
+cfg.read("config.ini")
+kwargs = {
+    "host": cfg.get("player_db", "host"),
+    "dbname": cfg.get("player_db", "dbname"),
+    "user": cfg.get("player_db", "user"),
+    "password": cfg.get("player_db", "password")
+}
+with psycopg2.connect(**kwargs) as conn:
+    with conn.cursor() as curs:
+        for table, fields in [("Inbox", INBOX_FIELDS), ("GameDataSnapshots", GAMEDATA_FIELDS)]:
+            primary = " ".join(fields[0])
+            other = ", ".join([key + " " + value_type for key, value_type in fields[1:]])
+            command = "CREATE TABLE {}({} PRIMARY KEY, {})".format(table, primary, other)
+            print command
+            curs.execute(command)
+        command = "CREATE INDEX InboxPart ON Inbox(PART, ID)"
+        print command
+        curs.execute(command)
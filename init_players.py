@@ -6,7 +6,7 @@ except:
 
 import psycopg2
 
-from db import FIELDS
+from db import get_fields
 
 cfg = configparser.RawConfigParser()
 cfg.read("config.ini")
@@ -16,10 +16,14 @@ kwargs = {
     "user": cfg.get("player_db", "user"),
     "password": cfg.get("player_db", "password")
 }
+blob_format = "json"
+if cfg.has_option("player_db", "blob_format"):
+    blob_format = cfg.get("player_db", "blob_format")
+fields = get_fields(blob_format)
 with psycopg2.connect(**kwargs) as conn:
     with conn.cursor() as curs:
-        primary = " ".join(FIELDS[0])
-        other = ", ".join([key + " " + value_type for key, value_type in FIELDS[1:]])
+        primary = " ".join(fields[0])
+        other = ", ".join([key + " " + value_type for key, value_type in fields[1:]])
         assert other
         command = "CREATE TABLE Players({} PRIMARY KEY, {})".format(primary, other)
         print command
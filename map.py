@@ -3,10 +3,24 @@
 from __future__ import print_function
 import logging
 import argparse
+import copy
+import cPickle as pickle
+import hashlib
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from bisect import bisect_right
+from multiprocessing.pool import ThreadPool
 import ConfigParser as configparser
 
-from httplib2 import Http
+from httplib2 import Http, HttpLib2Error
 from apiclient.discovery import build
+from apiclient.errors import HttpError
 from oauth2client import file, client, tools
 
 from constants import LOCATION_ID_MAX_LEN
@@ -25,6 +39,7 @@ DIR2DIR_ID = {
 }
 
 class Position(object):
+    __slots__ = ("_x", "_y", "_z")
 
     def __init__(self, x = 0, y = 0, z = 0):
         self._x = x
@@ -35,6 +50,7 @@ class Position(object):
         return "({}, {}, {})".format(self._x, self._y, self._z)
 
 class Transition(object):
+    __slots__ = ("_to_id", "_descr", "_multiplier", "_arrow", "_extra_button_markup")
 
     def __init__(self, to_id, descr, multiplier, arrow, extra_button_markup):
         self._to_id = to_id
@@ -44,6 +60,30 @@ class Transition(object):
         self._extra_button_markup = extra_button_markup
 
 
+class Sampler(object):
+    """
+    Sorted list of (accumulated probability, outcome) pairs that draws
+    an outcome by binary search: the first one whose accumulated
+    probability is greater than the draw.
+    """
+    __slots__ = ("_probs", "_outcomes")
+
+    def __init__(self, pairs=()):
+        self._probs = [acc_prob for acc_prob, _ in pairs]
+        self._outcomes = [outcome for _, outcome in pairs]
+
+    def __iter__(self):
+        return iter(zip(self._probs, self._outcomes))
+
+    def __len__(self):
+        return len(self._probs)
+
+    def choose(self, rng=random):
+        index = bisect_right(self._probs, rng.random())
+        assert index < len(self._probs), "bad probabilities"
+        return self._outcomes[index]
+
+
 def accumulate_probs(events):
     result = list()
     acc_prob = 0
@@ -51,7 +91,7 @@ def accumulate_probs(events):
         acc_prob += prob
         result.append((acc_prob, event_data))
     assert abs(1 - acc_prob) < 0.001, "invalid accumulated prob"
-    return result
+    return Sampler(result)
 
 
 class Location(object):
@@ -62,8 +102,11 @@ class Location(object):
     pos: Position
     adjacent: list of (dir_id, Transition)
     venues: list of (venue_id, venue_descr, research_threshold) tuples
-    venue_option2events: unicode -> events dict
+    events: Sampler of venue_id
+    venue_option2events: unicode -> Sampler of event_id
     """
+    __slots__ = ("_id", "_descr", "_size", "_research_rate", "_pos", "_adjacent", "_venues",
+                 "_events", "_venue_option2events")
 
     def __init__(self, id, descr, size, research_rate, pos, adjacent, venues, events):
         self._id = id
@@ -140,16 +183,16 @@ class Location(object):
                     if prob > 0:
                         events.append((prob, event_name))
                 row_index += 1
-            if events:
-                events = accumulate_probs(events)
+        events = accumulate_probs(events) if events else Sampler()
         return Location("", descr, size, research_rate, Position(x, y), adjacent, venues, events)
 
 class Venue(object):
     """
-    options - dict of (descr, message, events)
-        events is a sorted list of (accu prob, event_id)
-    events - sorted list of (accu prob, event_id)
+    options - list of (descr, message, events)
+        events is a Sampler of event_id
+    events - Sampler of event_id
     """
+    __slots__ = ("_name", "_options", "_events")
 
     def __init__(self, name, options, events):
         self._name = name
@@ -187,7 +230,7 @@ def load_venues(sheet_data):
 
                 options.append((option_text, option_message, accumulate_probs(events)))
             if venue_name != u"исследование":
-                venues[venue_id] = Venue(venue_name, options, list())
+                venues[venue_id] = Venue(venue_name, options, Sampler())
             else:
                 assert len(options) == 1
                 if venue_id not in venues:
@@ -198,6 +241,7 @@ def load_venues(sheet_data):
 
 
 class TextQuestOutcome(object):
+    __slots__ = ("_cnt", "_message", "_outcome_id")
 
     def __init__(self, cnt, message, outcome_id):
         self._cnt = cnt
@@ -248,6 +292,7 @@ class Event(object):
     options - option descr -> outcomes mapping, outcomes is a list of
             (accumulated probability, descr, outcome_id)
     """
+    __slots__ = ("_descr", "_options")
 
     def __init__(self, descr, options):
         self._descr = descr
@@ -255,6 +300,7 @@ class Event(object):
 
 
 class Item(object):
+    __slots__ = ("_name", "_descr", "_weight")
 
     def __init__(self, name, descr, weight):
         self._name = name
@@ -281,6 +327,7 @@ def load_items(sheet_data):
     return items
 
 class Program(object):
+    __slots__ = ("_name", "_descr", "_ram_usage", "_compile_time", "_cpu_usage")
 
     def __init__(self, name, descr, ram_usage, compile_time, cpu_usage):
         self._name = name
@@ -306,18 +353,36 @@ def load_programs(sheet_data):
     return programs
 
 
+# the id objects of loaded game data, so that players loaded from the
+# database share them instead of holding equal copies
+_ids = dict()
+
+
+def register_ids(ids):
+    for value in ids:
+        _ids.setdefault(value, value)
+
+
+def intern_id(value):
+    return _ids.get(value, value)
+
+
 class GameData(object):
     """
         map: location_id -> Location dict
         venues: venue_id -> Venue dict
+        sheet_hashes: sheet title -> hash of the values it was loaded from
+        reindex: ids of the locations to build venue_option2events for,
+            all of them by default
     """
 
-    def __init__(self, game_map, venues, texts, items, programs):
+    def __init__(self, game_map, venues, texts, items, programs, sheet_hashes=None,
+                 reindex=None):
         self._map = game_map
         self._venues = venues
         self._texts = texts
         self._items = items
-        for loc_id in game_map:
+        for loc_id in game_map if reindex is None else reindex:
             venue_option2events = dict()
             for venue_id, _, _ in game_map[loc_id]._venues:
                 if venue_id not in self._venues:
@@ -328,24 +393,180 @@ class GameData(object):
                     venue_option2events[option] = events
             game_map[loc_id]._venue_option2events = venue_option2events
         self._programs = programs
+        self._sheet_hashes = sheet_hashes if sheet_hashes is not None else dict()
+        self._register_ids()
+
+    def _register_ids(self):
+        for ids in (self._map, self._venues, self._items, self._programs):
+            register_ids(ids)
+
+    def __setstate__(self, state):
+        # loaded from a snapshot
+        self.__dict__.update(state)
+        self._register_ids()
+
+
+class GameDataHolder(object):
+    """
+    The current GameData. Loaded game data is never modified: a reload
+    builds a new GameData off to the side and swap() publishes it with a
+    single reference assignment. Handlers call get() once per update and
+    keep using that object, so an update never mixes old and new data.
+    """
+
+    def __init__(self, gamedata):
+        self._lock = threading.Lock()
+        self._gamedata = gamedata
+        self._version = 1
+
+    def get(self):
+        return self._gamedata
+
+    def get_version(self):
+        return self._version
+
+    def swap(self, gamedata, force=False):
+        """
+        Runs check_gamedata on gamedata first and refuses it if it misses
+        entities the current game data does not, unless force is set.
+        Returns whether gamedata was published and the newly missing
+        entities in check_gamedata order.
+        """
+        missing = check_gamedata(gamedata)
+        with self._lock:
+            old_missing = check_gamedata(self._gamedata)
+            introduced = tuple(sorted(set(new) - set(old))
+                               for new, old in zip(missing, old_missing))
+            if any(introduced) and not force:
+                return False, introduced
+            self._gamedata = gamedata
+            self._version += 1
+        return True, introduced
+
+
+SNAPSHOT_MAGIC = "CYBERGD\0"
+# bump whenever a pickled class changes its attributes
+SNAPSHOT_VERSION = 3
+SNAPSHOT_HEADER = struct.Struct("<8sI32s")
+SNAPSHOT_FILENAME = "gamedata.snapshot"
+
+
+def dump_snapshot(gamedata):
+    payload = pickle.dumps(gamedata, pickle.HIGHEST_PROTOCOL)
+    return SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                hashlib.sha256(payload).digest()) + payload
+
+
+def parse_snapshot(data, source):
+    """
+    source names where data came from in errors.
+    """
+    if len(data) < SNAPSHOT_HEADER.size:
+        raise Exception("SNAPSHOT_TRUNCATED\t{}".format(source))
+    magic, version, digest = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise Exception("SNAPSHOT_BAD_MAGIC\t{}".format(source))
+    if version != SNAPSHOT_VERSION:
+        raise Exception("SNAPSHOT_VERSION_MISMATCH\t{}\t{} != {}".format(
+                        source, version, SNAPSHOT_VERSION))
+    payload = buffer(data, SNAPSHOT_HEADER.size)
+    if hashlib.sha256(payload).digest() != digest:
+        raise Exception("SNAPSHOT_BAD_CHECKSUM\t{}".format(source))
+    return pickle.loads(str(payload))
+
+
+def save_snapshot(gamedata, filename):
+    """
+    Writes a temporary file and renames it, so a crash never leaves a
+    truncated snapshot behind. The temporary file is per process: cluster
+    workers started together may all save the snapshot at once.
+    """
+    data = dump_snapshot(gamedata)
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp_filename, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_filename, filename)
+
+
+def load_snapshot(filename):
+    with open(filename, "rb") as f:
+        return parse_snapshot(f.read(), filename)
 
-    def update(self, gamedata):
-        self.__init__(gamedata._map, gamedata._venues, gamedata._texts,
-                      gamedata._items, gamedata._programs)
 
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
-def load_spreadsheets(credentials_filename, spreadsheet_id):
+
+def get_service(credentials_filename):
     store = file.Storage(credentials_filename)
     creds = store.get()
-    service = build('sheets', 'v4', http=creds.authorize(Http()))
-    request = service.spreadsheets().get(spreadsheetId=spreadsheet_id,
-                                         ranges=[], includeGridData=False)
-    response = request.execute()
-    sheet_data = dict()
-    for sheet in response["sheets"]:
-        title = sheet["properties"]["title"]
-        sheet_data[title] = service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id, range=title).execute()
+    return build('sheets', 'v4', http=creds.authorize(Http()))
+
+
+def execute(request, retries):
+    for attempt in range(retries + 1):
+        try:
+            return request.execute()
+        except HttpError as e:
+            if e.resp.status not in RETRY_STATUSES or attempt == retries:
+                raise
+            error = e
+        except (socket.error, HttpLib2Error) as e:
+            if attempt == retries:
+                raise
+            error = e
+        logging.warning("sheets request failed, retrying: {}".format(error))
+        time.sleep(2 ** attempt)
+
+
+def quote_sheet_title(title):
+    return u"'{}'".format(title.replace(u"'", u"''"))
+
+
+def load_spreadsheets(credentials_filename, spreadsheet_id, make_service=None,
+                      chunk_size=50, threads=4, retries=3):
+    """
+    Fetches sheet values with values().batchGet, chunk_size sheets per
+    request and up to threads requests at once. make_service() builds a
+    Sheets service, one per thread as Http objects are not thread safe.
+    """
+    if make_service is None:
+        make_service = lambda: get_service(credentials_filename)
+    local = threading.local()
+
+    def get_local_service():
+        if not hasattr(local, "service"):
+            local.service = make_service()
+        return local.service
+
+    start = time.time()
+    response = execute(get_local_service().spreadsheets().get(
+        spreadsheetId=spreadsheet_id, ranges=[], includeGridData=False), retries)
+    titles = [sheet["properties"]["title"] for sheet in response["sheets"]]
+    metadata_time = time.time() - start
+
+    def fetch_chunk(chunk):
+        result = execute(get_local_service().spreadsheets().values().batchGet(
+            spreadsheetId=spreadsheet_id,
+            ranges=[quote_sheet_title(title) for title in chunk]), retries)
+        value_ranges = result.get("valueRanges", list())
+        assert len(value_ranges) == len(chunk), "batchGet returned {} of {} ranges".format(
+            len(value_ranges), len(chunk))
+        return zip(chunk, value_ranges)
+
+    start = time.time()
+    chunks = [titles[index:index + chunk_size] for index in range(0, len(titles), chunk_size)]
+    pool = ThreadPool(max(1, min(threads, len(chunks))))
+    try:
+        sheet_data = dict()
+        for pairs in pool.map(fetch_chunk, chunks):
+            sheet_data.update(pairs)
+    finally:
+        pool.close()
+        pool.join()
+    logging.info("fetched {} sheets in {} requests: metadata {:.2f}s, values {:.2f}s".format(
+                 len(titles), len(chunks), metadata_time, time.time() - start))
     return response, sheet_data
 
 
@@ -373,9 +594,13 @@ def check_gamedata(gamedata):
 
 
 def get_gamedata_status(gamedata):
-    missing_loc, missing_venues, missing_texts, missing_items = check_gamedata(gamedata)
+    return format_missing(u"Status check.", check_gamedata(gamedata))
+
+
+def format_missing(title, missing):
+    missing_loc, missing_venues, missing_texts, missing_items = missing
     return u"\n".join([
-        u"Status check.",
+        title,
         u"Missing locations:",
         u", ".join(missing_loc),
         u"Missing venues:",
@@ -387,13 +612,43 @@ def get_gamedata_status(gamedata):
     ])
 
 
-def load_gamedata(credentials_filename, spreadsheet_id):
-    spreadsheets_info, sheet2data = load_spreadsheets(credentials_filename, spreadsheet_id)
+def hash_sheet(data):
+    return hashlib.sha1(json.dumps(data.get("values", list()), sort_keys=True)).hexdigest()
+
+
+def get_venue_key(venue):
+    if venue is None:
+        return None
+    return (venue._name, [(option, message, list(events))
+                          for option, message, events in venue._options],
+            list(venue._events))
+
+
+def load_gamedata(credentials_filename, spreadsheet_id, previous=None, **load_options):
+    """
+    load_options are passed on to load_spreadsheets.
+
+    With previous game data only the sheets whose values changed since it
+    was loaded are parsed again, and only locations that are new or use a
+    changed venue get a new venue_option2events. Everything else is shared
+    with previous: loaded game data is never modified.
+    """
+    spreadsheets_info, sheet2data = load_spreadsheets(credentials_filename, spreadsheet_id,
+                                                      **load_options)
+    start = time.time()
+    sheet_hashes = dict((title, hash_sheet(data)) for title, data in sheet2data.iteritems())
+    old_hashes = previous._sheet_hashes if previous is not None else dict()
+    changed = set(title for title, sheet_hash in sheet_hashes.iteritems()
+                  if old_hashes.get(title) != sheet_hash)
 
     game_map = dict()
+    parsed = set()
     for title, data in sheet2data.iteritems():
         assert title not in game_map
         if title.isnumeric():
+            if title not in changed and title in previous._map:
+                game_map[title] = previous._map[title]
+                continue
             try:
                 location = Location.parse_from_sheet(data)
             except Exception as e:
@@ -402,30 +657,77 @@ def load_gamedata(credentials_filename, spreadsheet_id):
             location._id = title
             if location is not None:
                 game_map[location._id] = location
-    location_names = u", ".join(sorted(list(game_map.iterkeys()))).encode("utf8")
-    logging.info("loaded {} locations: {}".format(len(game_map), location_names))
-
-    venues = load_venues(sheet2data[u"локации"])
-    venue_names = u", ".join(sorted(list(venues.iterkeys()))).encode("utf8")
-    logging.info("loaded {} venues: {}".format(len(venues), venue_names))
-
-    texts = load_texts(sheet2data[u"тексты"])
-    logging.info("loaded {} texts".format(len(texts)))
-
-    items = load_items(sheet2data[u"Ресурсы"])
-    programs = load_programs(sheet2data[u"программы"])
-    return GameData(game_map, venues, texts, items, programs)
+                parsed.add(location._id)
+    location_names = u", ".join(sorted(parsed)).encode("utf8")
+    logging.info("loaded {} locations: {}".format(len(parsed), location_names))
+
+    if u"локации" in changed:
+        venues = load_venues(sheet2data[u"локации"])
+        venue_names = u", ".join(sorted(list(venues.iterkeys()))).encode("utf8")
+        logging.info("loaded {} venues: {}".format(len(venues), venue_names))
+    else:
+        venues = previous._venues
+
+    if u"тексты" in changed:
+        texts = load_texts(sheet2data[u"тексты"])
+        logging.info("loaded {} texts".format(len(texts)))
+    else:
+        texts = previous._texts
+
+    items = load_items(sheet2data[u"Ресурсы"]) if u"Ресурсы" in changed else previous._items
+    programs = (load_programs(sheet2data[u"программы"]) if u"программы" in changed
+                else previous._programs)
+
+    reindex = None
+    if previous is not None:
+        changed_venues = set()
+        if venues is not previous._venues:
+            changed_venues = set(venue_id for venue_id in set(venues) | set(previous._venues)
+                                 if get_venue_key(venues.get(venue_id))
+                                 != get_venue_key(previous._venues.get(venue_id)))
+        reindex = set(parsed)
+        for loc_id, location in game_map.iteritems():
+            if loc_id not in parsed and any(venue_id in changed_venues
+                                            for venue_id, _, _ in location._venues):
+                game_map[loc_id] = copy.copy(location)
+                reindex.add(loc_id)
+        logging.info("reloaded {} of {} sheets, reindexed {} locations".format(
+                     len(changed), len(sheet2data), len(reindex)))
+    gamedata = GameData(game_map, venues, texts, items, programs, sheet_hashes, reindex)
+    logging.info("parsed game data in {:.2f}s".format(time.time() - start))
+    return gamedata
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("cfg")
-    args = parser.parse_args()
+    subparsers = parser.add_subparsers(dest="command")
+    status = subparsers.add_parser("status", help="load game data and report missing entities")
+    status.add_argument("cfg")
+    snapshot = subparsers.add_parser("snapshot", help="load game data and save a snapshot")
+    snapshot.add_argument("cfg")
+    snapshot.add_argument("--output", help="defaults to snapshot in [gamedata] or "
+                                           + SNAPSHOT_FILENAME)
+    argv = sys.argv[1:]
+    # a bare "map.py cfg", as used before the subcommands, means status
+    if argv and argv[0] not in ("status", "snapshot", "-h", "--help"):
+        argv.insert(0, "status")
+    args = parser.parse_args(argv)
 
     cfg = configparser.RawConfigParser()
     cfg.read(args.cfg)
 
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                         level=logging.INFO)
-    gamedata = load_gamedata(cfg.get("auth", "credentials"), cfg.get("gamedata", "spreadsheet_id"))
+    # the classes of this script are __main__.GameData and so on, pickles of
+    # them would not load in run.py: build the game data with the module
+    import map as gamedata_module
+    gamedata = gamedata_module.load_gamedata(cfg.get("auth", "credentials"),
+                                             cfg.get("gamedata", "spreadsheet_id"))
     logging.info(get_gamedata_status(gamedata))
+    if args.command == "snapshot":
+        output = args.output
+        if output is None:
+            output = (cfg.get("gamedata", "snapshot") if cfg.has_option("gamedata", "snapshot")
+                      else SNAPSHOT_FILENAME)
+        gamedata_module.save_snapshot(gamedata, output)
+        logging.info("saved snapshot to {}".format(output))
@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+
+class RateLimiter(object):
+    """
+    Token bucket: rate tokens per second, at most burst tokens saved up.
+    """
+
+    def __init__(self, rate, burst):
+        self._rate = float(rate)
+        self._burst = burst
+        self._tokens = float(burst)
+        self._ts = time.time()
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._ts) * self._rate)
+        self._ts = now
+
+    def ready_at(self, now):
+        self._refill(now)
+        if self._tokens >= 1:
+            return now
+        return now + (1 - self._tokens) / self._rate
+
+    def reserve(self, now):
+        """
+        Takes a token, possibly one that is not there yet, and returns how
+        long to wait until it is.
+        """
+        self._refill(now)
+        self._tokens -= 1
+        return max(0.0, -self._tokens / self._rate)
+
+
+class Outbox(object):
+    """
+    Outgoing Telegram messages, sent by a pool of worker threads.
+
+    Stands in for the bot in handlers: send_message() only enqueues, any
+    other attribute is the wrapped bot's. A chat is served by at most one
+    worker at a time, so its messages keep their order. global_rate and
+    chat_rate (messages per second, with chat_burst messages allowed at
+    once) follow Telegram's limits; RetryAfter and network errors are
+    retried with backoff. A timed out message is not: Telegram may have
+    delivered it already and sendMessage is not idempotent, so it is
+    counted as failed and in timed_out instead of risking a duplicate.
+    """
+
+    def __init__(self, bot, workers=4, global_rate=30, chat_rate=1, chat_burst=3,
+                 max_retries=5):
+        self._bot = bot
+        self._workers = workers
+        self._max_retries = max_retries
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._cond = threading.Condition()
+        self._global_limiter = RateLimiter(global_rate, global_rate)
+        # chat_id -> (deque of (enqueue ts, args, kwargs), RateLimiter)
+        self._chats = dict()
+        # (ready ts, seq, chat_id) for chats not held by a worker
+        self._ready = list()
+        self._seq = itertools.count()
+        self._threads = list()
+        self._stopped = False
+        self._stats = {
+            "depth": 0,
+            "sent": 0,
+            "failed": 0,
+            "retries": 0,
+            "timed_out": 0,
+            "latency": 0.0,
+            "max_latency": 0.0
+        }
+
+    def __getattr__(self, name):
+        return getattr(self._bot, name)
+
+    def send_message(self, chat_id, *args, **kwargs):
+        now = time.time()
+        with self._cond:
+            if self._stopped:
+                raise Exception("OUTBOX_STOPPED")
+            if chat_id not in self._chats:
+                self._chats[chat_id] = (deque(), RateLimiter(self._chat_rate, self._chat_burst))
+                heapq.heappush(self._ready, (now, next(self._seq), chat_id))
+            self._chats[chat_id][0].append((now, args, kwargs))
+            self._stats["depth"] += 1
+            self._cond.notify()
+
+    def _next_chat(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._ready and self._ready[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    messages, limiter = self._chats[chat_id]
+                    if not messages:
+                        # only waited for the chat's rate limit to pass
+                        del self._chats[chat_id]
+                        continue
+                    limiter.reserve(now)
+                    return chat_id, messages.popleft()
+                if self._stopped and not self._chats:
+                    self._cond.notify_all()
+                    return None, None
+                self._cond.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _send(self, chat_id, args, kwargs):
+        for attempt in range(self._max_retries + 1):
+            with self._cond:
+                delay = self._global_limiter.reserve(time.time())
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self._bot.send_message(chat_id, *args, **kwargs)
+                return True
+            except RetryAfter as e:
+                delay = e.retry_after
+            except TimedOut:
+                logging.warning("OUTBOX_TIMED_OUT\t{}".format(chat_id))
+                with self._cond:
+                    self._stats["timed_out"] += 1
+                return False
+            except NetworkError:
+                delay = 0.5 * 2 ** attempt
+            except Exception:
+                logging.exception("OUTBOX_SEND_FAILED\t{}".format(chat_id))
+                return False
+            if attempt < self._max_retries:
+                logging.warning("OUTBOX_RETRY\t{}\t{}s".format(chat_id, delay))
+                with self._cond:
+                    self._stats["retries"] += 1
+                time.sleep(delay)
+        logging.error("OUTBOX_SEND_FAILED\t{}\tretries exhausted".format(chat_id))
+        return False
+
+    def _run(self):
+        while True:
+            chat_id, message = self._next_chat()
+            if chat_id is None:
+                return
+            enqueue_ts, args, kwargs = message
+            sent = self._send(chat_id, args, kwargs)
+            now = time.time()
+            with self._cond:
+                self._stats["depth"] -= 1
+                if sent:
+                    latency = now - enqueue_ts
+                    self._stats["sent"] += 1
+                    self._stats["latency"] += latency
+                    self._stats["max_latency"] = max(self._stats["max_latency"], latency)
+                else:
+                    self._stats["failed"] += 1
+                _, limiter = self._chats[chat_id]
+                heapq.heappush(self._ready, (limiter.ready_at(now), next(self._seq), chat_id))
+                self._cond.notify()
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["chats"] = len(self._chats)
+        if stats["sent"]:
+            stats["latency"] /= stats["sent"]
+        return stats
+
+    def start(self):
+        for index in range(self._workers):
+            thread = threading.Thread(target=self._run, name="outbox_{}".format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stops accepting messages and waits until the queued ones are sent.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        logging.info("OUTBOX_STOPPED\t{}".format(self.get_stats()))
@@ -1,61 +1,89 @@
 import logging
-import json
 import random
 import time
+import weakref
 
-from actions import ACTIONS, COMMANDS
+from actions import (ACTIONS, COMMANDS, get_keyboard, get_keyboard_actions,
+                     guess_suggested_actions)
 from constants import *
+from db import FIELDS, encode_blob, decode_blob
+from id_sets import IdSet, decode_id_set, encode_id_set
+from map import intern_id
 
 class Container(object):
+    """
+    Item id -> count, in the order the items were first put in. The total
+    weight is kept up to date by insert_item and remove_item when they get
+    the game data it was computed for, and recomputed when the game data
+    changes.
+    """
+    __slots__ = ("_items", "_order", "_weight", "_weight_of")
+    _max_weight = 15
 
     def __init__(self, items):
-        self._max_weight = 15
-        self._items = items
-
-    def insert_item(self, item_id, count):
-        for index, pair in enumerate(self._items):
-            cur_item_id, cur_count = pair
-            if item_id == cur_item_id:
-                self._items[index][1] += count
-                return
-        self._items.append([item_id, count])
-
-    def remove_item(self, item_id, count):
-        for index, pair in enumerate(self._items):
-            cur_item_id, cur_count = pair
-            if item_id == cur_item_id:
-                if self._items[index][1] < count:
-                    raise Exception("trying to remove more than have")
-                self._items[index][1] -= count
-                if self._items[index][1] == 0:
-                    del self._items[index]
-                return
-        raise Exception("trying to remove unexisting item {}".format(item_id))
+        self._items = dict()
+        self._order = list()
+        for item_id, count in items:
+            item_id = intern_id(item_id)
+            self._items[item_id] = count
+            self._order.append(item_id)
+        self._weight = 0
+        # the GameData _weight is for
+        self._weight_of = None
+
+    def _has_weight(self, gamedata):
+        return self._weight_of is not None and self._weight_of() is gamedata
+
+    def _add_weight(self, item_id, count, gamedata):
+        if gamedata is not None and self._has_weight(gamedata):
+            self._weight += gamedata._items[item_id]._weight * count
+        else:
+            self._weight_of = None
+
+    def insert_item(self, item_id, count, gamedata=None):
+        if item_id not in self._items:
+            self._items[item_id] = 0
+            self._order.append(item_id)
+        self._items[item_id] += count
+        self._add_weight(item_id, count, gamedata)
+
+    def remove_item(self, item_id, count, gamedata=None):
+        if item_id not in self._items:
+            raise Exception("trying to remove unexisting item {}".format(item_id))
+        if self._items[item_id] < count:
+            raise Exception("trying to remove more than have")
+        self._items[item_id] -= count
+        if self._items[item_id] == 0:
+            del self._items[item_id]
+            self._order.remove(item_id)
+        self._add_weight(item_id, -count, gamedata)
 
     def get_count(self, item_id):
-        for index, pair in enumerate(self._items):
-            cur_item_id, cur_count = pair
-            if item_id == cur_item_id:
-                return self._items[index][1]
-        return 0
+        return self._items.get(item_id, 0)
+
+    def get_items(self):
+        return [(item_id, self._items[item_id]) for item_id in self._order]
 
     def get_weight(self, gamedata):
-        result = 0
-        for item_id, count in self._items:
-            result += gamedata._items[item_id]._weight * count
-        return result
+        if not self._has_weight(gamedata):
+            self._weight = sum(gamedata._items[item_id]._weight * count
+                               for item_id, count in self._items.iteritems())
+            self._weight_of = weakref.ref(gamedata)
+        return self._weight
 
     def to_dict(self):
-        return {"items": self._items}
+        return {"items": [[item_id, count] for item_id, count in self.get_items()]}
 
     @staticmethod
     def from_dict(d):
         return Container(d["items"])
 
+
 class Avatar(object):
+    __slots__ = ("_backpack",)
 
-    def __init__(self, backpack=Container([])):
-        self._backpack = backpack
+    def __init__(self, backpack=None):
+        self._backpack = backpack if backpack is not None else Container([])
 
     def to_dict(self):
         return {"backpack": self._backpack.to_dict()}
@@ -65,39 +93,283 @@ class Avatar(object):
         return Avatar(Container.from_dict(d["backpack"]))
 
 
-class Player(object):
+def encode_value(value):
+    return value
+
+
+def encode_avatar(value):
+    return encode_blob(value.to_dict()) if value is not None else None
+
+
+# (Player attribute, Players column, encoder) in db.FIELDS order
+COLUMNS = zip([
+    "_user_id",
+    "_chat_id",
+    "_location_id",
+    "_stored_keyboard_id",
+    "_lore",
+    "_raw_lore",
+    "_lore_last_update",
+    "_research_percent",
+    "_running_soft",
+    "_known_soft",
+    "_compiling_soft",
+    "_installed_soft",
+    "_avatar",
+    "_known_entities"
+], [field for field, _ in FIELDS], [
+    encode_value,
+    encode_value,
+    encode_value,
+    encode_blob,
+    encode_value,
+    encode_value,
+    encode_value,
+    encode_blob,
+    encode_id_set,
+    encode_id_set,
+    encode_blob,
+    encode_id_set,
+    encode_avatar,
+    encode_id_set
+])
+ATTR2COLUMN = dict((attr, (field, encoder)) for attr, field, encoder in COLUMNS)
+
+
+def decode_keyboard(player, data):
+    keyboard_id = decode_blob(data)
+    suggested_actions = None
+    if isinstance(keyboard_id, dict):
+        # written before keyboards had ids: the whole button -> action map
+        keyboard_id, suggested_actions = None, keyboard_id
+        player._changed.add("_stored_keyboard_id")
+    elif keyboard_id is not None:
+        keyboard_id = tuple(keyboard_id)
+    object.__setattr__(player, "_keyboard_id", keyboard_id)
+    object.__setattr__(player, "_suggested_actions", suggested_actions)
+    return keyboard_id
+
+
+def decode_research_percent(player, data):
+    research_percent = dict((intern_id(loc_id), percent)
+                            for loc_id, percent in decode_blob(data).iteritems())
+    research_percent.setdefault(player._location_id, 0)
+    return research_percent
+
+
+def decode_compiling_soft(player, data):
+    compiling_soft = decode_blob(data)
+    if compiling_soft:
+        compiling_soft[0] = intern_id(compiling_soft[0])
+    return compiling_soft
+
+
+def decode_installed_soft(player, data):
+    installed_soft = decode_id_set(data)
+    running_soft = player._running_soft
+    if running_soft & installed_soft:
+        logging.warning("PLAYER_SOFT_INCONSISTENT\t{}\trunning and installed: {}".format(
+            player._user_id, sorted(running_soft & installed_soft)))
+        installed_soft -= running_soft
+    return installed_soft
+
+
+def decode_avatar(player, data):
+    return Avatar.from_dict(decode_blob(data)) if data is not None else Avatar()
+
+
+# (Player attribute, row index, decoder) of the columns from_row leaves
+# undecoded until first use
+LAZY_COLUMNS = [
+    ("_stored_keyboard_id", 3, decode_keyboard),
+    ("_research_percent", 7, decode_research_percent),
+    ("_running_soft", 8, lambda player, data: decode_id_set(data)),
+    ("_known_soft", 9, lambda player, data: decode_id_set(data)),
+    ("_compiling_soft", 10, decode_compiling_soft),
+    ("_installed_soft", 11, decode_installed_soft),
+    ("_avatar", 12, decode_avatar),
+    ("_known_entities", 13, lambda player, data: decode_id_set(data))
+]
+LAZY_DECODERS = dict((attr, decoder) for attr, _, decoder in LAZY_COLUMNS)
+# attributes set by the decoder of another attribute's column
+LAZY_ALIASES = {
+    "_keyboard_id": "_stored_keyboard_id",
+    "_suggested_actions": "_stored_keyboard_id"
+}
+
 
-    def __init__(self, user_id, chat_id, location_id="001", suggested_actions={},
-                 lore=1024, raw_lore=0, lore_last_update=None, research_percent={},
-                 running_soft=set(), known_soft=set(), compiling_soft=[],
-                 installed_soft=set(), avatar=Avatar(), known_entities=set()):
+class Player(object):
+    """
+    Assigning a stored attribute marks it as changed, in-place mutations of
+    stored sets and dicts must call mark_changed(). pop_changed_columns()
+    serializes only the changed columns.
+
+    keyboard_id identifies the last keyboard sent (see actions.KEYBOARDS),
+    it is stored and the keyboard rebuilt from it after a restart.
+
+    Game data ids of players loaded from the database are interned with
+    map.intern_id, so the player cache does not hold a copy of every id
+    for every player. Known entities and soft are IdSet bitsets.
+
+    from_row() keeps the blob columns as they came from the database (see
+    LAZY_COLUMNS) and decodes each on first access, so commands that do
+    not touch them don't pay for decoding; to_row() writes untouched
+    columns back as they were.
+    """
+    __slots__ = ("_changed", "_raw", "_user_id", "_chat_id", "_keyboard_id", "_stored_keyboard_id",
+                 "_suggested_actions", "_lore", "_raw_lore", "_lore_last_update", "_used_ram",
+                 "_used_cpu", "_resources_of", "_research_percent", "_location_id",
+                 "_known_soft", "_running_soft", "_compiling_soft", "_installed_soft",
+                 "_avatar", "_known_entities")
+
+    def __init__(self, user_id, chat_id, location_id="001", keyboard_id=None,
+                 lore=1024, raw_lore=0, lore_last_update=None, research_percent=None,
+                 running_soft=None, known_soft=None, compiling_soft=None,
+                 installed_soft=None, avatar=None, known_entities=None):
+        # players now live in PlayerCache, so defaults must not be shared
+        object.__setattr__(self, "_changed", set())
+        object.__setattr__(self, "_raw", dict())
         self._user_id = user_id
         self._chat_id = chat_id
-        self._suggested_actions = suggested_actions
+        self._keyboard_id = keyboard_id
+        self._stored_keyboard_id = keyboard_id
+        # button text -> action, built lazily from _keyboard_id
+        self._suggested_actions = None
         self._lore = lore
         self._raw_lore = raw_lore
         self._lore_last_update = lore_last_update
+        # RAM and CPU of the running programs, see _has_resources
         self._used_ram = 0
         self._used_cpu = 0
-        self._research_percent = research_percent
+        self._resources_of = None
+        self._research_percent = research_percent if research_percent is not None else dict()
         self.set_location(location_id)
-        self._known_soft = known_soft
-        self._running_soft = running_soft
-        self._compiling_soft = compiling_soft
-        self._installed_soft = installed_soft
-        self._avatar = avatar
-        self._known_entities = known_entities
-
-    def set_actions(self, keyboard):
-        self._suggested_actions = dict()
-        for row in keyboard:
-            for action, button_text in row:
-                self._suggested_actions[button_text] = action
+        self._known_soft = known_soft if known_soft is not None else IdSet()
+        self._running_soft = running_soft if running_soft is not None else IdSet()
+        self._compiling_soft = compiling_soft if compiling_soft is not None else list()
+        self._installed_soft = installed_soft if installed_soft is not None else IdSet()
+        self._avatar = avatar if avatar is not None else Avatar()
+        self._known_entities = known_entities if known_entities is not None else IdSet()
+
+    def _decode(self, attr):
+        data = self._raw.pop(attr)
+        object.__setattr__(self, attr, LAZY_DECODERS[attr](self, data))
+
+    def __getattr__(self, name):
+        # only called for attributes that are not set: undecoded columns
+        if name != "_raw":
+            attr = LAZY_ALIASES.get(name, name)
+            if attr in self._raw:
+                self._decode(attr)
+                return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        attr = LAZY_ALIASES.get(name, name)
+        if attr in self._raw:
+            # the column's decoder may set other attributes too
+            self._decode(attr)
+        if name in ATTR2COLUMN:
+            self._changed.add(name)
+        object.__setattr__(self, name, value)
+
+    def mark_changed(self, attr):
+        assert attr in ATTR2COLUMN, "not a stored attribute: {}".format(attr)
+        self._changed.add(attr)
+
+    def clear_changed(self):
+        self._changed.clear()
+
+    def pop_changed_columns(self):
+        columns = dict()
+        for attr in self._changed:
+            field, encoder = ATTR2COLUMN[attr]
+            columns[field] = encoder(getattr(self, attr))
+        self._changed.clear()
+        return columns
+
+    def set_keyboard(self, keyboard_id, keyboard, suggested_actions=None):
+        self._keyboard_id = keyboard_id
+        if suggested_actions is None:
+            suggested_actions = get_keyboard_actions(keyboard)
+        self._suggested_actions = suggested_actions
+        if keyboard_id != self._stored_keyboard_id:
+            self._stored_keyboard_id = keyboard_id
+
+    def get_suggested_actions(self, gamedata):
+        if self._suggested_actions is None:
+            if self._keyboard_id is not None:
+                self._suggested_actions = get_keyboard_actions(
+                    get_keyboard(self._keyboard_id, self, gamedata))
+            else:
+                self._suggested_actions = guess_suggested_actions(self, gamedata)
+        return self._suggested_actions
 
     def set_location(self, loc_id):
         self._location_id = loc_id
         if loc_id not in self._research_percent:
             self._research_percent[loc_id] = 0
+            self.mark_changed("_research_percent")
+
+    def add_research(self, loc_id, researched):
+        self._research_percent[loc_id] += researched
+        self.mark_changed("_research_percent")
+
+    def _has_resources(self, gamedata):
+        """
+        Whether _used_ram and _used_cpu are up to date for gamedata. Like
+        Container's weight, the totals are kept up to date by
+        start_program and stop_program when they get that game data, and
+        recounted when the game data changes.
+        """
+        return self._resources_of is not None and self._resources_of() is gamedata
+
+    def _count_resources(self, gamedata):
+        used_ram, used_cpu = 0, 0
+        for program_id in self._running_soft:
+            program = gamedata._programs[program_id]
+            used_ram += program._ram_usage
+            used_cpu += program._cpu_usage
+        if self._resources_of is None and (used_ram > self.get_ram() or
+                                           used_cpu > self.get_cpu()):
+            # do_run_program never lets this happen, so the row is off
+            logging.warning("PLAYER_RESOURCES_EXCEEDED\t{}\tram {} / {}\tcpu {} / {}".format(
+                self._user_id, used_ram, self.get_ram(), used_cpu, self.get_cpu()))
+        self._used_ram = used_ram
+        self._used_cpu = used_cpu
+        self._resources_of = weakref.ref(gamedata)
+
+    def _add_resources(self, program_id, sign, gamedata):
+        if gamedata is not None and self._has_resources(gamedata):
+            program = gamedata._programs[program_id]
+            self._used_ram += sign * program._ram_usage
+            self._used_cpu += sign * program._cpu_usage
+        else:
+            self._resources_of = None
+
+    def start_program(self, program_id, gamedata=None):
+        self._installed_soft.remove(program_id)
+        self._running_soft.add(program_id)
+        self._add_resources(program_id, 1, gamedata)
+        self.mark_changed("_installed_soft")
+        self.mark_changed("_running_soft")
+
+    def stop_program(self, program_id, gamedata=None):
+        self._running_soft.remove(program_id)
+        self._installed_soft.add(program_id)
+        self._add_resources(program_id, -1, gamedata)
+        self.mark_changed("_installed_soft")
+        self.mark_changed("_running_soft")
+
+    def insert_item(self, item_id, count, gamedata=None):
+        self._avatar._backpack.insert_item(item_id, count, gamedata)
+        self.mark_changed("_avatar")
+
+    def set_delayed_action(self, bot, delay, action):
+        return bot.scheduler.schedule(self._user_id, delay, action)
+
+    def cancel_delayed_action(self, bot):
+        return bot.scheduler.cancel(self._user_id)
 
     def do_action(self, action, bot, gamedata, pdb):
         name = action[0]
@@ -105,10 +377,10 @@ class Player(object):
         if name not in ACTIONS and name not in COMMANDS:
             raise Exception("UNIMPLEMENTED_ACTION\t{}".format(name))
         assert name not in ACTIONS or name not in COMMANDS
-        logging.info("PLAYER: {}\tACTION: {}\tSUGGESTED_ACTIONS:{}".format(
-            self._user_id, name,
-            json.dumps(self._suggested_actions,
-                       ensure_ascii=False).encode("utf8"))
+        # not worth decoding the keyboard column for the log
+        keyboard_id = self._keyboard_id if "_stored_keyboard_id" not in self._raw else "-"
+        logging.info("PLAYER: {}\tACTION: {}\tKEYBOARD: {}".format(
+            self._user_id, name, keyboard_id)
         )
         if name in ACTIONS:
             ACTIONS[name](self, bot, gamedata, pdb, *args)
@@ -116,10 +388,11 @@ class Player(object):
             COMMANDS[name](self, bot, gamedata, pdb, *args)
 
     def handle_text_update(self, text, bot, gamedata, pdb):
-        if text not in self._suggested_actions:
+        suggested_actions = self.get_suggested_actions(gamedata)
+        if text not in suggested_actions:
             logging.info(u"{} not in suggested actions".format(text).encode("utf8"))
             return
-        action = self._suggested_actions[text]
+        action = suggested_actions[text]
         if type(action) in {str, unicode}:
             action = (action,)
         self.do_action(action, bot, gamedata, pdb)
@@ -128,9 +401,9 @@ class Player(object):
         return int(self._lore ** 0.5)
 
     def get_used_cpu(self, gamedata):
-        used = 0
-        for program in self._running_soft:
-            used += gamedata._programs[program]._cpu_usage
+        if not self._has_resources(gamedata):
+            self._count_resources(gamedata)
+        used = self._used_cpu
         if self._compiling_soft:
             program, cpu, start_time, last_check = self._compiling_soft
             used += cpu
@@ -140,10 +413,9 @@ class Player(object):
         return self._lore / 10
 
     def get_used_ram(self, gamedata):
-        used = 0
-        for program in self._running_soft:
-            used += gamedata._programs[program]._ram_usage
-        return used
+        if not self._has_resources(gamedata):
+            self._count_resources(gamedata)
+        return self._used_ram
 
     def get_name(self):
         return u"id_{}".format(self._user_id)
@@ -154,6 +426,7 @@ class Player(object):
         d = 2.0 * (300 * len(gamedata._map) - 10 * len(gamedata._items)) / len(gamedata._items) / (len(gamedata._items) + 1)
         gained = int(10 + len(self._known_entities) * d)
         self._known_entities.add(entity_id)
+        self.mark_changed("_known_entities")
         self._raw_lore += gained
         return gained
 
@@ -178,6 +451,7 @@ class Player(object):
             finish_ts = start_time + compile_time / cpu * TICK_DURATION
             if ts >= finish_ts:
                 self._installed_soft.add(program)
+                self.mark_changed("_installed_soft")
                 self._compiling_soft = []
 
 #            compile_check_period = 12 * TICK_DURATION
@@ -197,48 +471,35 @@ class Player(object):
 
     @staticmethod
     def from_row(row):
+        player = Player.__new__(Player)
         user_id, chat_id, location_id = row[:3]
-        suggested_actions = json.loads(row[3])
         lore, raw_lore, lore_last_update = row[4:7]
-        research_percent = json.loads(row[7])
-        running_soft = set(json.loads(row[8]))
-        known_soft = set(json.loads(row[9]))
-        compiling_soft = json.loads(row[10])
-        installed_soft = set(json.loads(row[11]))
-        avatar = Avatar.from_dict(json.loads(row[12])) if row[12] is not None else None
-        known_entities = set(json.loads(row[13]))
-        return Player(user_id, chat_id, location_id, suggested_actions, lore,
-                      raw_lore, lore_last_update, research_percent,
-                      running_soft, known_soft, compiling_soft, installed_soft,
-                      avatar, known_entities)
+        for attr, value in [
+                ("_changed", set()),
+                ("_raw", dict((attr, row[index]) for attr, index, _ in LAZY_COLUMNS)),
+                ("_user_id", user_id),
+                ("_chat_id", chat_id),
+                ("_location_id", intern_id(location_id)),
+                ("_lore", lore),
+                ("_raw_lore", raw_lore),
+                ("_lore_last_update", lore_last_update),
+                ("_used_ram", 0),
+                ("_used_cpu", 0),
+                ("_resources_of", None)]:
+            object.__setattr__(player, attr, value)
+        return player
 
     def to_row(self):
-        serialized = json.dumps(self._suggested_actions)
-        assert len(serialized) < SUGGESTED_ACTIONS_MAX_LEN
-        research_percent = json.dumps(self._research_percent)
-        assert len(research_percent) < SUGGESTED_ACTIONS_MAX_LEN
-        return [
-            self._user_id,
-            self._chat_id,
-            self._location_id,
-            serialized,
-            self._lore,
-            self._raw_lore,
-            self._lore_last_update,
-            research_percent,
-            json.dumps(list(self._running_soft)),
-            json.dumps(list(self._known_soft)),
-            json.dumps(self._compiling_soft),
-            json.dumps(list(self._installed_soft)),
-            json.dumps(self._avatar.to_dict()) if self._avatar is not None else None,
-            json.dumps(list(self._known_entities))
-        ]
+        return [self._raw[attr] if attr in self._raw else encoder(getattr(self, attr))
+                for attr, _, encoder in COLUMNS]
 
 
 def fetch_player(user_id, db):
     with db.connect() as conn:
         with conn.cursor() as curs:
-            curs.execute("SELECT * FROM Players WHERE USER_ID = %s", (user_id,))
+            # explicit columns: convert_player_blobs.py changes the table's column order
+            curs.execute("SELECT {} FROM Players WHERE USER_ID = %s".format(
+                         ", ".join(field for field, _ in FIELDS)), (user_id,))
             rows = curs.fetchall()
             assert len(rows) <= 1, "duplicate user_id's in database: {}".format(user_id)
             if rows:
@@ -0,0 +1,263 @@
+import logging
+import select
+import threading
+import time
+from collections import OrderedDict
+
+from db import INVALIDATE_CHANNEL, add_player, update_players
+from player import fetch_player
+
+
+class PlayerCache(object):
+    """
+    Write-behind identity map of Player objects keyed by user_id.
+
+    fetch() returns the same Player object for a user as long as it is
+    cached and younger than ttl seconds, so repeated messages skip both the
+    SELECT and the JSON decode. invalidate() drops an entry, admin scripts
+    do the same from outside with notify_players_changed(). When an admin
+    script and the bot change the same column, the admin script wins:
+    pending writes of the reported columns are dropped, not flushed over it.
+
+    update() only records the serialized columns the player changed since
+    the last call, a background thread writes them to PostgreSQL in batches
+    every flush_interval seconds. At most max_dirty players (and at most
+    flush_interval seconds of changes) can be lost on a crash: reaching
+    max_dirty makes the caller flush synchronously. Clean entries are
+    evicted in LRU order once the cache holds more than max_size players.
+
+    A handler may still hold an object when it is invalidated. update()
+    then neither caches it again nor writes the columns the edit set; its
+    other changes are written as usual.
+    """
+
+    def __init__(self, db, max_size=10000, ttl=300, flush_interval=1.0,
+                 max_dirty=500, flush_batch=100):
+        self._db = db
+        self._max_size = max_size
+        self._ttl = ttl
+        self._flush_interval = flush_interval
+        self._max_dirty = max_dirty
+        self._flush_batch = flush_batch
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # user_id -> (player, time it was loaded or last written)
+        self._players = OrderedDict()
+        self._dirty = OrderedDict()
+        # user_id -> (invalidated object, columns of the edit or None for
+        # all of them) until the user is loaded again
+        self._invalidated = OrderedDict()
+        self._threads = list()
+        self._stopped = False
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "invalidated": 0
+        }
+
+    def connect(self):
+        return self._db.connect()
+
+    def fetch(self, user_id):
+        with self._lock:
+            entry = self._players.pop(user_id, None)
+            if entry is not None:
+                player, ts = entry
+                if user_id in self._dirty or time.time() - ts < self._ttl:
+                    self._players[user_id] = entry
+                    self._stats["hits"] += 1
+                    return player
+                self._stats["expired"] += 1
+            self._stats["misses"] += 1
+            pending = user_id in self._dirty
+        if pending:
+            self.flush()
+        player = fetch_player(user_id, self._db)
+        if player is None:
+            return None
+        with self._lock:
+            entry = self._players.pop(user_id, None)
+            if entry is not None:
+                player = entry[0]
+            self._players[user_id] = (player, time.time())
+            self._invalidated.pop(user_id, None)
+            self._evict()
+        return player
+
+    def add(self, player):
+        with self._db.connect() as conn:
+            add_player(player, conn)
+        player.clear_changed()
+        with self._lock:
+            self._players.pop(player._user_id, None)
+            self._players[player._user_id] = (player, time.time())
+            self._invalidated.pop(player._user_id, None)
+            self._evict()
+
+    def update(self, player):
+        columns = player.pop_changed_columns()
+        with self._lock:
+            invalidated = self._invalidated.get(player._user_id)
+            entry = self._players.get(player._user_id)
+            if invalidated is not None and invalidated[0] is player:
+                edited = invalidated[1]
+                columns = dict((column, value) for column, value in columns.iteritems()
+                               if edited is not None and column not in edited)
+            elif entry is None or entry[0] is player:
+                self._players.pop(player._user_id, None)
+                self._players[player._user_id] = (player, time.time())
+            if not columns:
+                return
+            pending = self._dirty.pop(player._user_id, dict())
+            pending.update(columns)
+            self._dirty[player._user_id] = pending
+            overflow = len(self._dirty) >= self._max_dirty
+        if overflow:
+            self.flush()
+
+    def invalidate(self, user_id, columns=None):
+        """
+        Drops the cached object and its pending writes of columns, all of
+        them if None, so the row as edited outside wins over changes this
+        process has not written yet. Pending writes of other columns are
+        flushed by the next fetch() before it loads the row.
+        """
+        with self._lock:
+            self._drop(user_id, frozenset(columns) if columns is not None else None)
+            pending = self._dirty.pop(user_id, None)
+            if pending is not None and columns is not None:
+                for column in columns:
+                    pending.pop(column, None)
+                if pending:
+                    self._dirty[user_id] = pending
+
+    def invalidate_all(self, columns=None):
+        """
+        Drops all cached objects and every player's pending writes of
+        columns. Without columns pending writes are kept: that only says
+        rows may have changed, e.g. while nobody listened, not which
+        values an edit set.
+        """
+        with self._lock:
+            for user_id in set(self._players) | set(self._invalidated):
+                self._drop(user_id, frozenset(columns or ()))
+            for user_id, pending in self._dirty.items():
+                for column in columns or ():
+                    pending.pop(column, None)
+                if not pending:
+                    del self._dirty[user_id]
+
+    def _drop(self, user_id, columns):
+        entry = self._players.pop(user_id, None)
+        invalidated = self._invalidated.pop(user_id, None)
+        if entry is None and invalidated is None:
+            return
+        if entry is not None:
+            self._stats["invalidated"] += 1
+        else:
+            # invalidated again before the user was loaded
+            entry = invalidated
+            if columns is not None:
+                columns = None if invalidated[1] is None else columns | invalidated[1]
+        self._invalidated[user_id] = (entry[0], columns)
+        while len(self._invalidated) > self._max_size:
+            self._invalidated.popitem(last=False)
+
+    def flush(self):
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = list()
+                    while self._dirty and len(batch) < self._flush_batch:
+                        batch.append(self._dirty.popitem(last=False))
+                if not batch:
+                    break
+                try:
+                    with self._db.connect() as conn:
+                        update_players(batch, conn)
+                except Exception:
+                    logging.exception("PLAYER_CACHE_FLUSH_FAILED\t{} players".format(len(batch)))
+                    with self._lock:
+                        for user_id, columns in batch:
+                            columns.update(self._dirty.pop(user_id, dict()))
+                            self._dirty[user_id] = columns
+                    raise
+            with self._lock:
+                self._evict()
+
+    def _evict(self):
+        if len(self._players) <= self._max_size:
+            return
+        for user_id in list(self._players):
+            if len(self._players) <= self._max_size:
+                break
+            if user_id not in self._dirty:
+                del self._players[user_id]
+
+    def _handle_notify(self, payload):
+        for entry in payload.split(","):
+            if entry.strip():
+                user_id, columns = entry.split(":", 1) if ":" in entry else (entry, None)
+                columns = columns.split(":") if columns is not None else None
+                if user_id.strip() == "*":
+                    self.invalidate_all(columns)
+                else:
+                    self.invalidate(int(user_id), columns)
+
+    def _run_flush(self):
+        while not self._stopped:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                time.sleep(self._flush_interval)
+
+    def _run_listen(self):
+        conn = None
+        while not self._stopped:
+            try:
+                if conn is None:
+                    conn = self._db.listen(INVALIDATE_CHANNEL)
+                    # entries loaded while nobody listened may be stale
+                    self.invalidate_all()
+                if select.select([conn], [], [], self._flush_interval) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self._handle_notify(conn.notifies.pop(0).payload)
+            except Exception:
+                logging.exception("PLAYER_CACHE_LISTEN_FAILED")
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                time.sleep(self._flush_interval)
+        if conn is not None:
+            conn.close()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._players)
+            stats["dirty"] = len(self._dirty)
+        fetches = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = float(stats["hits"]) / fetches if fetches else 0.0
+        return stats
+
+    def start(self):
+        for target, name in [(self._run_flush, "player_cache_flush"),
+                             (self._run_listen, "player_cache_listen")]:
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        self.flush()
+        logging.info("PLAYER_CACHE_STOPPED\t{}".format(self.get_stats()))
@@ -1,6 +1,15 @@
 #!/usr/bin/env bash
-PID=`ps x | grep run.py | grep python | awk '{print $1}'`
-if [[ -n $PID ]]; then
-    kill $PID
+# The new process loads game data, then stops the one in run.pid and takes
+# over once the old one has drained its queues and flushed its players.
+# ./restart.sh [config.ini]
+CONFIG=${1:-config.ini}
+PID_DIR=`python -c "import ConfigParser; c = ConfigParser.RawConfigParser(); c.read('$CONFIG'); print c.get('restart', 'pid_dir') if c.has_option('restart', 'pid_dir') else '.'"`
+if [[ ! -f $PID_DIR/run.pid ]]; then
+    # no pid file: nothing is running or it predates the handoff; cluster
+    # processes (run.py --role ...) are left alone
+    PID=`ps x | grep run.py | grep python | grep -v -- --role | awk '{print $1}'`
+    if [[ -n $PID ]]; then
+        kill $PID
+    fi
 fi
-nohup python run.py config.ini &
+nohup python run.py $CONFIG &
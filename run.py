@@ -7,152 +7,480 @@ try:
 except:
     import ConfigParser as configparser
 import logging
-import threading
 import json
+import os
+import signal
+import threading
 
-from telegram import ChatAction
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, Handler
+from telegram import ChatAction, Update
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, Handler, TypeHandler
 
-from map import load_gamedata, get_gamedata_status
-from player import Player, fetch_player
+from map import (SNAPSHOT_FILENAME, GameDataHolder, format_missing, load_gamedata,
+                 get_gamedata_status, load_snapshot, save_snapshot)
+from player import Player
+from player_cache import PlayerCache
 import delayed_actions
-from db import DB, add_player, update_player, send_message
+from db import DB, send_message, set_blob_format
+from actions import START_KEYBOARD
+from outbox import Outbox
+from shards import ShardPool
+from cluster import GameDataBroadcast, InboxConsumer, UpdateRouter, fetch_published_gamedata
+from handoff import Handoff
+from stats import StatsLogger
+from id_sets import IdRegistry, register_gamedata_ids, set_registry
 
 
 class StartCommandHandlerCallback(object):
 
-    def __init__(self, players):
+    def __init__(self, players, outbox):
         self._players = players
+        self._bot = outbox
 
-    def __call__(self, bot, update):
+    def __call__(self, _, update):
+        bot = self._bot
         user_id = update.message.from_user.id
-        player = fetch_player(user_id, self._players)
+        player = self._players.fetch(user_id)
         if player is not None:
             return
         player = Player(user_id, update.message.chat_id)
         text = "User {} is welcome in chat {}".format(user_id, update.message.chat_id)
-        keyboard = [[("CONTINUE", u"Продолжить")]]
-        with self._players.connect() as conn:
-            add_player(player, conn)
-            send_message(player, conn, bot, text, keyboard)
+        self._players.add(player)
+        send_message(player, self._players, bot, text, START_KEYBOARD, ("START",))
         logging.info("NEW_USER\t{}".format(user_id))
 
 class RestartCommandHandlerCallback(object):
 
-    def __init__(self, players):
+    def __init__(self, players, outbox):
         self._players = players
+        self._bot = outbox
 
-    def __call__(self, bot, update):
+    def __call__(self, _, update):
+        bot = self._bot
         user_id = update.message.from_user.id
-        player = fetch_player(user_id, self._players)
+        player = self._players.fetch(user_id)
         if player is None:
             return
+        self._players.invalidate(user_id)
         player = Player(user_id, update.message.chat_id)
         text = "User {} is welcome in chat {}".format(user_id, update.message.chat_id)
-        keyboard = [[("CONTINUE", u"Продолжить")]]
-        with self._players.connect() as conn:
-            update_player(player, conn)
-            send_message(player, conn, bot, text, keyboard)
+        self._players.update(player)
+        send_message(player, self._players, bot, text, START_KEYBOARD, ("START",))
         logging.info("NEW_USER\t{}".format(user_id))
 
 class ReloadCommandHandlerCallback(object):
-
-    def __init__(self, gamedata, credentials, spreadsheet_id):
-        self._gamedata = gamedata
-        self._credentials = credentials
-        self._spreadsheet_id = spreadsheet_id
-
-    def __call__(self, bot, update):
-        bot.send_message(update.message.chat_id, text="Refreshing game data...")
-        bot.send_chat_action(update.message.chat_id, ChatAction.TYPING, timeout=15)
-        try:
-            new_game_data = load_gamedata(self._credentials, self._spreadsheet_id)
-        except Exception as e:
-            bot.send_message(update.message.chat_id,
-                text="Failed to load gamedata. Details: {}".format(e))
+    """
+    "/reload force" publishes the new game data even if it misses
+    entities the current one does not.
+    """
+
+    def __init__(self, gamedata_loader, outbox):
+        self._gamedata_loader = gamedata_loader
+        self._bot = outbox
+        self._lock = threading.Lock()
+
+    def __call__(self, _, update):
+        chat_id = update.message.chat_id
+        force = update.message.text.split()[1:] == ["force"]
+        if not self._lock.acquire(False):
+            self._bot.send_message(chat_id, text="Game data is already being reloaded")
             return
-
-        self._gamedata.update(new_game_data)
-        bot.send_message(update.message.chat_id,
-                         text=u"Game data was updated.\n{}".format(
-                             get_gamedata_status(self._gamedata)))
+        # loading takes a while, keep it off the dispatcher's threads
+        thread = threading.Thread(target=self._reload, args=(chat_id, force),
+                                  name="gamedata_reload")
+        thread.daemon = True
+        thread.start()
+
+    def _reload(self, chat_id, force):
+        bot = self._bot
+        try:
+            bot.send_message(chat_id, text="Refreshing game data...")
+            bot.send_chat_action(chat_id, ChatAction.TYPING, timeout=15)
+            try:
+                swapped, introduced = self._gamedata_loader.reload(force)
+            except Exception as e:
+                logging.exception("GAMEDATA_RELOAD_FAILED")
+                bot.send_message(chat_id, text="Failed to load gamedata. Details: {}".format(e))
+                return
+            if not swapped:
+                bot.send_message(chat_id, text=format_missing(
+                    u"Game data was NOT updated, use /reload force to apply it anyway.",
+                    introduced))
+                return
+            bot.send_message(chat_id, text=u"Game data was updated.\n{}".format(
+                get_gamedata_status(self._gamedata_loader.get())))
+        finally:
+            self._lock.release()
 
 class TextHandlerCallback(object):
 
-    def __init__(self, players, gamedata):
+    def __init__(self, players, gamedata_holder, outbox):
         self._players = players
-        self._gamedata = gamedata
+        self._gamedata_holder = gamedata_holder
+        self._bot = outbox
 
-    def __call__(self, bot, update):
+    def __call__(self, _, update):
+        bot = self._bot
         user_id = update.message.from_user.id
-        player = fetch_player(user_id, self._players)
+        player = self._players.fetch(user_id)
         if player is None:
             raise Exception("UNEXPECTED_USER_ID: {}".format(user_id))
         text = update.message.text
-        player.handle_text_update(text, bot, self._gamedata, self._players)
+        player.handle_text_update(text, bot, self._gamedata_holder.get(), self._players)
 
 class ActionCommandHandler(Handler):
 
-    def __init__(self, players, gamedata):
-        Handler.__init__(self, None)
-        self._gamedata = gamedata
-        self._players = players
-
     def check_update(self, update):
         return update.message is not None and update.message.text.startswith(u"/")
 
     def handle_update(self, update, dispatcher):
-        bot = dispatcher.bot
+        return self.callback(dispatcher.bot, update)
+
+class ActionCommandHandlerCallback(object):
+
+    def __init__(self, players, gamedata_holder, outbox):
+        self._players = players
+        self._gamedata_holder = gamedata_holder
+        self._bot = outbox
+
+    def __call__(self, _, update):
+        bot = self._bot
         user_id = update.message.from_user.id
-        player = fetch_player(user_id, self._players)
+        player = self._players.fetch(user_id)
         if player is None:
             raise Exception("UNEXPECTED_USER_ID: {}".format(user_id))
         text = update.message.text
-        player.do_action(text.split(u"_", 1), bot, self._gamedata, self._players)
+        player.do_action(text.split(u"_", 1), bot, self._gamedata_holder.get(),
+                         self._players)
+
+
+def store_snapshot(gamedata, snapshot):
+    try:
+        save_snapshot(gamedata, snapshot)
+    except Exception:
+        logging.exception("GAMEDATA_SNAPSHOT_SAVE_FAILED\t{}".format(snapshot))
 
 
-def run_main_loop(token, credentials, spreadsheet_id, players):
+class GameDataLoader(object):
+    """
+    Reloads game data from the spreadsheet into gamedata_holder, then
+    saves the snapshot file and, in a cluster, publishes it to the other
+    workers through broadcast.
+    """
+
+    def __init__(self, gamedata_holder, credentials, spreadsheet_id, load_options, snapshot,
+                 broadcast=None):
+        self._gamedata_holder = gamedata_holder
+        self._credentials = credentials
+        self._spreadsheet_id = spreadsheet_id
+        self._load_options = load_options
+        self._snapshot = snapshot
+        self._broadcast = broadcast
+
+    def get(self):
+        return self._gamedata_holder.get()
+
+    def reload(self, force=False):
+        new_game_data = load_gamedata(self._credentials, self._spreadsheet_id,
+                                      previous=self._gamedata_holder.get(), **self._load_options)
+        swapped, introduced = self._gamedata_holder.swap(new_game_data, force)
+        if swapped:
+            logging.info("GAMEDATA_SWAPPED\t{}".format(self._gamedata_holder.get_version()))
+            register_gamedata_ids(new_game_data)
+            store_snapshot(new_game_data, self._snapshot)
+            if self._broadcast is not None:
+                self._broadcast.publish(new_game_data)
+        else:
+            logging.warning(format_missing(u"GAMEDATA_REJECTED", introduced).encode("utf8"))
+        return swapped, introduced
+
+    def refresh(self):
+        try:
+            self.reload()
+        except Exception:
+            logging.exception("GAMEDATA_REFRESH_FAILED")
+
+    def start_refresh(self):
+        thread = threading.Thread(target=self.refresh, name="gamedata_refresh")
+        thread.daemon = True
+        thread.start()
+
+
+def load_initial_gamedata(credentials, spreadsheet_id, load_options, snapshot):
+    """
+    Returns the snapshot's game data and whether it still has to be
+    refreshed from the spreadsheet; without a usable snapshot the
+    spreadsheet is loaded right away.
+    """
+    if os.path.exists(snapshot):
+        try:
+            gamedata = load_snapshot(snapshot)
+            logging.info("GAMEDATA_SNAPSHOT_LOADED\t{}".format(snapshot))
+            return gamedata, True
+        except Exception:
+            logging.exception("GAMEDATA_SNAPSHOT_LOAD_FAILED\t{}".format(snapshot))
+    gamedata = load_gamedata(credentials, spreadsheet_id, **load_options)
+    logging.info(get_gamedata_status(gamedata).encode("utf8"))
+    store_snapshot(gamedata, snapshot)
+    return gamedata, False
+
+
+def wait_for_stop_signal():
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stopped.set())
+    while not stopped.is_set():
+        # a wait without timeout would not let signal handlers run
+        stopped.wait(1)
+
+
+def start_updates(updater, token, telegram_options):
+    """
+    polling: long polls getUpdates, poll_timeout seconds per request.
+    webhook: Telegram posts updates to the updater's HTTP server on
+        listen:port/url_path (the token by default). webhook_url, required
+        in this mode, is the URL Telegram posts to, e.g. the public URL of
+        a proxy in front of that path.
+    """
+    mode = telegram_options["mode"]
+    if mode == "polling":
+        updater.start_polling(timeout=telegram_options["poll_timeout"],
+                              read_latency=telegram_options["read_latency"])
+    elif mode == "webhook":
+        updater.start_webhook(listen=telegram_options["listen"],
+                              port=telegram_options["port"],
+                              url_path=telegram_options["url_path"] or token,
+                              cert=telegram_options["cert"],
+                              key=telegram_options["key"],
+                              webhook_url=telegram_options["webhook_url"])
+    else:
+        raise Exception("UNKNOWN_UPDATES_MODE\t{}".format(mode))
+    logging.info("UPDATES_STARTED\t{}".format(mode))
+
+
+def confirm_updates(updater, telegram_options):
+    """
+    The updater confirms fetched updates only with its next getUpdates,
+    so after stop() the next process would get the last batch again.
+    """
+    if telegram_options["mode"] == "polling" and updater.last_update_id:
+        updater.bot.get_updates(offset=updater.last_update_id, limit=1, timeout=0)
+
+
+def run_ingest(token, db, partitions, telegram_options, handoff, stats):
+    """
+    Cluster front: receives updates from Telegram and routes them to the
+    inboxes of the workers.
+    """
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO, filename="log.tsv")
+    updater = Updater(token=token, base_url=telegram_options["base_url"])
+    updater.dispatcher.add_handler(TypeHandler(Update, UpdateRouter(db, partitions)))
+    stats.start()
+    handoff.take_over()
+    start_updates(updater, token, telegram_options)
+    updater.idle()
+    confirm_updates(updater, telegram_options)
+    stats.stop()
+    db.close()
+    handoff.release()
+
+
+def run_main_loop(token, credentials, spreadsheet_id, load_options, snapshot, db, players,
+                  outbox_options, scheduler_options, shard_count, telegram_options, handoff,
+                  stats, partition=None):
+    """
+    Everything is loaded and started before handoff takes over from the
+    previous process, only delayed actions and updates wait for it.
+
+    partition: (index, count) makes this process a cluster worker that
+        serves the users with user_id % count == index, taking their
+        updates from the inbox instead of from Telegram
+    """
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                         level=logging.INFO, filename="load_log.tsv")
-    gamedata = load_gamedata(credentials, spreadsheet_id)
-    logging.info(get_gamedata_status(gamedata).encode("utf8"))
+    registry = IdRegistry(db)
+    registry.load()
+    set_registry(registry)
+    published = fetch_published_gamedata(db) if partition is not None else None
+    if published is not None and published[1] is not None:
+        snapshot_id, gamedata = published
+        stale = False
+    else:
+        # nothing published yet or unreadable by this build: load it here
+        # and publish it over the stale one
+        snapshot_id = None
+        gamedata, stale = load_initial_gamedata(credentials, spreadsheet_id, load_options,
+                                                snapshot)
+    gamedata_holder = GameDataHolder(gamedata)
+    register_gamedata_ids(gamedata)
+    broadcast = None
+    if partition is not None:
+        broadcast = GameDataBroadcast(db, gamedata_holder, snapshot_id)
+        if snapshot_id is None:
+            broadcast.publish(gamedata)
+    gamedata_loader = GameDataLoader(gamedata_holder, credentials, spreadsheet_id,
+                                     load_options, snapshot, broadcast)
 
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                         level=logging.INFO, filename="log.tsv")
-    updater = Updater(token=token)
-    updater.bot.delayed_action_lock = threading.Lock()
-    updater.bot.delayed_actions = list()
+    updater = Updater(token=token, base_url=telegram_options["base_url"])
     dispatcher = updater.dispatcher
+    outbox = Outbox(updater.bot, **outbox_options)
+    stats.add("OUTBOX_STATS", outbox.get_stats)
+    stats.add("PLAYER_CACHE_STATS", players.get_stats)
+    # updates of one user run in order on the user's shard, so that two
+    # quick taps don't race on the same player
+    shards = ShardPool(shard_count)
+    stats.add("SHARDS_STATS", shards.get_stats)
+    scheduler = delayed_actions.Scheduler(outbox, players, gamedata_holder, shards,
+                                          partition=partition, **scheduler_options)
+    updater.bot.scheduler = scheduler
 
     handlers = [
-        CommandHandler("start", StartCommandHandlerCallback(players)),
-        CommandHandler("restart", RestartCommandHandlerCallback(players)),
-        CommandHandler("reload",
-                       ReloadCommandHandlerCallback(gamedata, credentials,
-                                                    spreadsheet_id)
-                       ),
-        MessageHandler(Filters.text, TextHandlerCallback(players, gamedata)),
-        ActionCommandHandler(players, gamedata)
+        CommandHandler("start", shards.wrap(StartCommandHandlerCallback(players, outbox))),
+        CommandHandler("restart", shards.wrap(RestartCommandHandlerCallback(players, outbox))),
+        CommandHandler("reload", shards.wrap(
+            ReloadCommandHandlerCallback(gamedata_loader, outbox))),
+        MessageHandler(Filters.text,
+                       shards.wrap(TextHandlerCallback(players, gamedata_holder, outbox))),
+        ActionCommandHandler(
+            shards.wrap(ActionCommandHandlerCallback(players, gamedata_holder, outbox)))
     ]
 
     for handler in handlers:
         dispatcher.add_handler(handler)
 
-    updater.start_polling(read_latency=0.1, timeout=0.1)
+    players.start()
+    outbox.start()
+    shards.start()
+    stats.start()
+    handoff.take_over()
+    scheduler.start()
+    if stale:
+        gamedata_loader.start_refresh()
+    if partition is None:
+        start_updates(updater, token, telegram_options)
+        updater.idle()
+        confirm_updates(updater, telegram_options)
+    else:
+        inbox = InboxConsumer(db, dispatcher, shards, partition[0])
+        inbox.start()
+        broadcast.start()
+        logging.info("WORKER_STARTED\t{}/{}".format(*partition))
+        wait_for_stop_signal()
+        inbox.stop()
+        broadcast.stop()
+    stats.stop()
+    scheduler.stop()
+    shards.stop()
+    if partition is not None:
+        inbox.ack()
+    players.stop()
+    outbox.stop()
+    # shared by everything above, closed once all of it has stopped
+    db.close()
+    handoff.release()
+
+
+def get_option(cfg, section, option, default, convert=str):
+    if not cfg.has_option(section, option):
+        return default
+    return convert(cfg.get(section, option))
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("cfg")
+    parser.add_argument("--role", choices=["single", "ingest", "worker"],
+                        help="overrides [cluster] role")
+    parser.add_argument("--partition", type=int,
+                        help="partition of a worker, overrides [cluster] partition")
     args = parser.parse_args()
 
     cfg = configparser.RawConfigParser()
     cfg.read(args.cfg)
 
-    players = DB(cfg.get("player_db", "host"), cfg.get("player_db", "dbname"),
-            cfg.get("player_db", "user"), cfg.get("player_db", "password"))
+    set_blob_format(get_option(cfg, "player_db", "blob_format", "json"))
+    db = DB(cfg.get("player_db", "host"), cfg.get("player_db", "dbname"),
+            cfg.get("player_db", "user"), cfg.get("player_db", "password"),
+            min_size=get_option(cfg, "player_db", "pool_min_size", 1, int),
+            max_size=get_option(cfg, "player_db", "pool_max_size", 8, int),
+            max_idle=get_option(cfg, "player_db", "pool_max_idle", 300, float),
+            checkout_timeout=get_option(cfg, "player_db", "pool_timeout", 10, float))
+    players = PlayerCache(db,
+            max_size=get_option(cfg, "player_db", "cache_size", 10000, int),
+            ttl=get_option(cfg, "player_db", "cache_ttl", 300, float),
+            flush_interval=get_option(cfg, "player_db", "flush_interval", 1.0, float),
+            max_dirty=get_option(cfg, "player_db", "max_dirty", 500, int))
+    outbox_options = {
+        "workers": get_option(cfg, "outbox", "workers", 4, int),
+        "global_rate": get_option(cfg, "outbox", "global_rate", 30, float),
+        "chat_rate": get_option(cfg, "outbox", "chat_rate", 1, float),
+        "chat_burst": get_option(cfg, "outbox", "chat_burst", 3, int)
+    }
+    scheduler_options = {
+        "poll_interval": get_option(cfg, "delayed_actions", "poll_interval", 1.0, float),
+        "batch_size": get_option(cfg, "delayed_actions", "batch_size", 100, int),
+        "lease": get_option(cfg, "delayed_actions", "lease", 300.0, float)
+    }
+    telegram_options = {
+        "mode": get_option(cfg, "telegram", "mode", "polling"),
+        # e.g. http://127.0.0.1:8081/bot for fake_telegram.py
+        "base_url": get_option(cfg, "telegram", "base_url", None),
+        "poll_timeout": get_option(cfg, "telegram", "poll_timeout", 30, int),
+        "read_latency": get_option(cfg, "telegram", "read_latency", 2.0, float),
+        "listen": get_option(cfg, "telegram", "listen", "127.0.0.1"),
+        "port": get_option(cfg, "telegram", "port", 8443, int),
+        "url_path": get_option(cfg, "telegram", "url_path", ""),
+        "webhook_url": get_option(cfg, "telegram", "webhook_url", None),
+        "cert": get_option(cfg, "telegram", "cert", None),
+        "key": get_option(cfg, "telegram", "key", None)
+    }
+    if telegram_options["mode"] == "webhook" and telegram_options["webhook_url"] is None:
+        # PTB would register https://<listen>:<port>/<url_path>, which
+        # Telegram can't reach for the default listen of 127.0.0.1
+        raise Exception("WEBHOOK_URL_MISSING\tset webhook_url in [telegram] for mode = webhook")
+    load_options = {
+        "chunk_size": get_option(cfg, "gamedata", "chunk_size", 50, int),
+        "threads": get_option(cfg, "gamedata", "threads", 4, int),
+        "retries": get_option(cfg, "gamedata", "retries", 3, int)
+    }
+    # single: one process does everything
+    # ingest: receives updates and routes them to the workers' inboxes
+    # worker: serves the users of one partition, see run_main_loop
+    role = args.role or get_option(cfg, "cluster", "role", "single")
+    partitions = get_option(cfg, "cluster", "partitions", 1, int)
+    stats = StatsLogger(get_option(cfg, "stats", "interval", 60, float))
+    stats.add("DB_POOL_STATS", db.get_pool_stats)
+    # restart.sh starts a new process, which stops the one recorded in
+    # the role's pid file once it is ready to take over
+    pid_dir = get_option(cfg, "restart", "pid_dir", ".")
+    handoff_timeout = get_option(cfg, "restart", "timeout", 120, float)
+    if role == "ingest":
+        run_ingest(cfg.get("auth", "token"), db, partitions, telegram_options,
+                   Handoff(os.path.join(pid_dir, "ingest.pid"), handoff_timeout), stats)
+        return
+    partition = None
+    if role == "worker":
+        index = args.partition
+        if index is None:
+            index = cfg.getint("cluster", "partition")
+        assert 0 <= index < partitions, "bad partition {} of {}".format(index, partitions)
+        partition = (index, partitions)
+        # [outbox] global_rate is Telegram's limit for the bot as a whole,
+        # the workers share it; chats belong to a single worker
+        outbox_options["global_rate"] /= partitions
+        pid_file = "worker_{}.pid".format(index)
+    elif role == "single":
+        pid_file = "run.pid"
+    else:
+        raise Exception("UNKNOWN_CLUSTER_ROLE\t{}".format(role))
     run_main_loop(cfg.get("auth", "token"), cfg.get("auth", "credentials"),
-                  cfg.get("gamedata", "spreadsheet_id"), players)
+                  cfg.get("gamedata", "spreadsheet_id"), load_options,
+                  get_option(cfg, "gamedata", "snapshot", SNAPSHOT_FILENAME), db, players,
+                  outbox_options, scheduler_options,
+                  get_option(cfg, "dispatch", "shards", 8, int), telegram_options,
+                  Handoff(os.path.join(pid_dir, pid_file), handoff_timeout), stats, partition)
 
 
 if __name__ == "__main__":
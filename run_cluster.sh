@@ -0,0 +1,9 @@
+#!/usr/bin/env bash
+# Starts an ingest process and one worker per partition on this host:
+# ./run_cluster.sh config.ini, with [cluster] partitions = N in config.ini.
+CONFIG=${1:-config.ini}
+PARTITIONS=`python -c "import ConfigParser; c = ConfigParser.RawConfigParser(); c.read('$CONFIG'); print c.getint('cluster', 'partitions')"`
+for ((i = 0; i < PARTITIONS; i++)); do
+    nohup python run.py $CONFIG --role worker --partition $i > worker_$i.out 2>&1 &
+done
+nohup python run.py $CONFIG --role ingest > ingest.out 2>&1 &
@@ -0,0 +1,75 @@
+import logging
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class ShardPool(object):
+    """
+    A fixed pool of worker threads with a queue each. Tasks submitted with
+    the same key (a user id) go to the same worker and run one at a time
+    in submission order, tasks with different keys run in parallel.
+    """
+
+    def __init__(self, shards=8):
+        self._queues = [queue.Queue() for _ in range(shards)]
+        self._processed = [0] * shards
+        self._lock = threading.Lock()
+        self._threads = list()
+        self._stopped = False
+
+    def submit(self, key, func, *args):
+        with self._lock:
+            if self._stopped:
+                raise Exception("SHARDS_STOPPED")
+            self._queues[hash(key) % len(self._queues)].put((func, args))
+
+    def wrap(self, callback):
+        """
+        Turns a (bot, update) handler callback into one that runs on the
+        shard of the update's user.
+        """
+        def dispatch(bot, update):
+            self.submit(update.message.from_user.id, callback, bot, update)
+        return dispatch
+
+    def _run(self, index):
+        tasks = self._queues[index]
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                logging.exception("SHARD_TASK_FAILED\t{}".format(index))
+            self._processed[index] += 1
+
+    def get_stats(self):
+        return {
+            "depth": [tasks.qsize() for tasks in self._queues],
+            "processed": list(self._processed)
+        }
+
+    def start(self):
+        for index in range(len(self._queues)):
+            thread = threading.Thread(target=self._run, args=(index,),
+                                      name="shard_{}".format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stops accepting tasks and waits until the queued ones are done.
+        """
+        with self._lock:
+            self._stopped = True
+            for tasks in self._queues:
+                tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        logging.info("SHARDS_STOPPED\t{}".format(self.get_stats()))
@@ -0,0 +1,44 @@
+import logging
+import threading
+
+
+class StatsLogger(object):
+    """
+    Logs the stats of running components every interval seconds, so pool
+    waits, queue depths and hit rates can be watched while the bot runs.
+    The components log their final stats themselves when they stop.
+    interval 0 turns it off.
+    """
+
+    def __init__(self, interval):
+        self._interval = interval
+        # (log tag, function returning a stats dict)
+        self._sources = list()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, tag, get_stats):
+        self._sources.append((tag, get_stats))
+
+    def log(self):
+        for tag, get_stats in self._sources:
+            try:
+                logging.info("{}\t{}".format(tag, get_stats()))
+            except Exception:
+                logging.exception("STATS_FAILED\t{}".format(tag))
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.log()
+
+    def start(self):
+        if self._interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name="stats")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()